@@ -1,9 +1,31 @@
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import csv
+import ctypes
+import ctypes.util
 import datetime
+import json
+import math
 import os
+import select
 import shutil
+import sqlite3
+import struct
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
 
 def getDatetime(dtStr, model):
     if model == "d5": # YYYY_MMDD_HHMMSS_00_a/b.mp4
@@ -31,333 +53,1634 @@ def getDatetime(dtStr, model):
                                 int(components[4]), # Minute
                                 int(components[5][:2])) # Second
 
+# Dash cam models
+# cameras: filename suffix of each camera, "A" is the front camera, "B" the rear one (shown as PIP)
+# stemLength: number of characters to remove from the filename to get the name of the compressed video
+cameraModels = {
+    "d5": { # YYYY_MMDD_HHMMSS_00_a/b.MP4
+        "description": "PAPAGO D5",
+        "cameras": {"A": "a.MP4", "B": "b.MP4"},
+        "stemLength": 9
+    },
+    "s80wifi": { # YYYY_MMDD_HHMMSS_123A/B.MP4
+        "description": "PAPAGO S80Wifi",
+        "cameras": {"A": "A.MP4", "B": "B.MP4"},
+        "stemLength": 5
+    },
+    "s36": { # YYYY-MM-DD-HH-MM-SS.MOV
+        "description": "PAPAGO S36",
+        "cameras": {"A": ".MOV"},
+        "stemLength": 4
+    }
+}
+
+# Encoders
+# args: fixed encoding parameters
+# preset: speed preset option, its default value, and the faster one used for static videos, None if the encoder has no preset
+# quality: rate control option, its default value (None means choosing the CRF from the resolution),
+# the values sampled by the rate control mode, and the range of the option
+# threads: how to limit the number of threads, "x265" (thread pools) or "ffmpeg" (-threads), None if it's not CPU bound
+# suffix: appended to the name of the compressed video
+encoders = {
+    "libx265": {
+        "args": ['-c:v', 'libx265', '-vtag', 'hvc1', '-g', '240', '-b:v', '0'], # Let CRF control bitrate
+        "preset": ['-preset', '5', 'ultrafast'],
+        "quality": ['-crf', None, [26, 32, 38], [0, 51]], # Constant Rate Factor (0-51, lower = better quality)
+        "threads": "x265",
+        "suffix": ""
+    },
+    "hevc_nvenc": { # Nvidia GPU
+        "args": ['-c:v', 'hevc_nvenc', '-vtag', 'hvc1', '-g', '240', '-rc', 'constqp'],
+        "preset": None,
+        "quality": ['-qp', '37', [31, 37, 43], [0, 51]],
+        "threads": None,
+        "suffix": ""
+    },
+    "hevc_videotoolbox": { # Apple GPU
+        "args": ['-c:v', 'hevc_videotoolbox', '-vtag', 'hvc1', '-g', '240'],
+        "preset": None,
+        "quality": ['-q:v', '25', [15, 25, 35], [1, 100]], # Higher = better quality
+        "threads": None,
+        "suffix": ""
+    },
+    "libaom-av1": {
+        "args": ['-c:v', 'libaom-av1',
+                 '-row-mt', '1', # Enable row-based multithreading
+                 '-tiles', '2x2', # Split encoding into 2x2 tiles for better parallelization
+                 '-g', '240',
+                 '-b:v', '0'], # Let CRF control bitrate
+        "preset": ['-cpu-used', '8', '8'], # Speed preset (0-8, lower = better quality but slower)
+        "quality": ['-crf', '55', [45, 52, 59], [0, 63]], # Constant Rate Factor (0-63, lower = better quality)
+        "threads": "ffmpeg",
+        "suffix": "_AV1"
+    },
+    "libsvtav1": {
+        "args": ['-c:v', 'libsvtav1',
+                 '-svtav1-params', 'fast-decode=1', # Enable fast decoding mode
+                 '-g', '240'],
+        "preset": ['-preset', '8', '12'], # Encoding speed preset (0-13, higher = faster)
+        "quality": ['-crf', '55', [45, 52, 59], [1, 63]], # Constant Rate Factor (1-63, lower = better quality)
+        "threads": "ffmpeg",
+        "suffix": "_AV1"
+    },
+    "libx264": {
+        "args": ['-c:v', 'libx264', '-g', '240'],
+        "preset": ['-preset', 'medium', 'ultrafast'],
+        "quality": ['-crf', '28', [22, 28, 34], [0, 51]], # Constant Rate Factor (0-51, lower = better quality)
+        "threads": "ffmpeg",
+        "suffix": "_H264"
+    }
+}
+
+# Encoder used by the --processor and --codec options
+def defaultEncoder(processor, codec):
+    if codec == 1: # AV1
+        return "libaom-av1"
+    return ["libx265", "hevc_nvenc", "hevc_videotoolbox"][processor]
+
+# Rear camera as a mirrored picture-in-picture with rounded corners, on top of the front camera
+pipFilter = "[0]crop=iw:ih*3/4:0:ih/8[overlay];[overlay]hflip[overlay];[overlay]format=yuva420p,geq=lum='p(X,Y)':a='if(gt(abs(W/2-X),W/2-32)*gt(abs(H/2-Y),H/2-32),if(lte(hypot(32-(W/2-abs(W/2-X)),32-(H/2-abs(H/2-Y))),32),255,0),255)'[overlay];[overlay][1]scale2ref=iw/3:ow/mdar[overlay][main];[main][overlay]overlay=main_w/3:main_h/50"
+
+# Same graph, but the rounded corners come from a mask generated once per overlay resolution (input 2),
+# instead of evaluating the geq expression for every pixel of every frame
+# The mask is decoded once and repeated by the loop filter, a looped input (-loop 1) would never end
+pipMaskFilter = "[0]crop=iw:ih*3/4:0:ih/8[overlay];[overlay]hflip[overlay];[overlay]format=yuva420p[overlay];[2]format=gray,loop=loop=-1:size=1[mask];[overlay][mask]alphamerge=shortest=1[overlay];[overlay][1]scale2ref=iw/3:ow/mdar[overlay][main];[main][overlay]overlay=main_w/3:main_h/50"
+pipMaskExpression = "if(gt(abs(W/2-X),W/2-32)*gt(abs(H/2-Y),H/2-32),if(lte(hypot(32-(W/2-abs(W/2-X)),32-(H/2-abs(H/2-Y))),32),255,0),255)"
+pipMaskLock = threading.Lock()
+
+# Returns the path of the rounded corners mask of an overlay video, generating it if needed
+# Returns None if the overlay video can't be probed
+def pipMask(overlayFile, maskDir):
+    probe = probeVideo(overlayFile)
+    if probe is None or probe["width"] is None:
+        return None
+    # Size of the cropped overlay, crop rounds down to even sizes for yuv420p
+    width, height = probe["width"] & ~1, (probe["height"] * 3 // 4) & ~1
+    maskPath = os.path.join(maskDir, ".pip_mask_" + str(width) + "x" + str(height) + ".png")
+    with pipMaskLock:
+        if not os.path.exists(maskPath):
+            command = ['ffmpeg', '-loglevel', 'error', '-y',
+                       '-f', 'lavfi', '-i', 'color=c=white:s=' + str(width) + 'x' + str(height) + ',format=gray',
+                       '-vf', "geq=lum='" + pipMaskExpression + "'",
+                       '-frames:v', '1', maskPath + ".tmp.png"]
+            if subprocess.Popen(command, stdout=subprocess.DEVNULL).wait() != 0:
+                if os.path.exists(maskPath + ".tmp.png"):
+                    os.remove(maskPath + ".tmp.png")
+                return None
+            os.replace(maskPath + ".tmp.png", maskPath)
+    return maskPath
+
+audioArgs = ['-c:a', 'aac', '-b:a', '64k', '-ac', '1']
+
+# Progress is reported through stdout, see runFfmpeg()
+ffmpegArgs = ['ffmpeg', '-nostats', '-progress', 'pipe:1', '-loglevel', 'error']
+
+# Compact record of a clip, parsed once from its filename
+# camera is "A" (front) or "B" (rear), size is None if the directory isn't known
+Clip = collections.namedtuple("Clip", ["name", "timestamp", "camera", "model", "size"])
+
+# Returns None if the file isn't a clip of this model
+def parseClip(filename, model, dir=None):
+    name = clipName(filename)
+    cameras = [camera for camera, suffix in cameraModels[model]["cameras"].items() if name.endswith(suffix)]
+    if len(cameras) == 0:
+        return None
+    camera = cameras[0]
+    try:
+        timestamp = getDatetime(name, model)
+    except (ValueError, IndexError):
+        return None
+    size = None if dir is None else os.path.getsize(os.path.join(dir, filename))
+    return Clip(filename, timestamp, camera, model, size)
+
+# Parses all the filenames in one pass, and returns the time-sorted clips of each camera
+def indexClips(filenames, model, dir=None):
+    clips = {}
+    for filename in filenames:
+        clip = parseClip(filename, model, dir)
+        if clip is not None:
+            clips.setdefault(clip.camera, []).append(clip)
+    for camera in clips:
+        clips[camera].sort(key=lambda clip: (clip.timestamp, clip.name))
+    return clips
+
+# Matches the front & rear items (clips or groups of clips) starting within the tolerance (in seconds), with a two-pointer sweep
+# Returns time-ordered (front, rear) pairs, either of them is None if it has no match
+def pairClips(front, rear, tolerance):
+    tolerance = datetime.timedelta(seconds=tolerance)
+    pairs = []
+    i, j = 0, 0
+    while i < len(front) or j < len(rear):
+        if j == len(rear) or (i < len(front) and front[i].timestamp < rear[j].timestamp - tolerance):
+            pairs.append((front[i], None))
+            i += 1
+        elif i == len(front) or rear[j].timestamp < front[i].timestamp - tolerance:
+            pairs.append((None, rear[j]))
+            j += 1
+        else:
+            pairs.append((front[i], rear[j]))
+            i += 1
+            j += 1
+    return pairs
+
+# In stream mode, catFiles() writes a concat list instead of the concatenated video,
+# and the encoder reads the original clips in place through the concat demuxer
+concatListExt = ".ffconcat"
+
+# Name of the staged clip, without the concat list extension
+def clipName(path):
+    return path[:-len(concatListExt)] if path.endswith(concatListExt) else path
+
+# ffmpeg input parameters for a staged clip or a concat list
+def inputArgs(path):
+    if path.endswith(concatListExt):
+        return ['-err_detect', 'ignore_err', '-f', 'concat', '-safe', '0', '-i', path]
+    return ['-i', path]
+
+# Clips of a concat list, or the file itself
+def listedClips(path):
+    if not path.endswith(concatListExt):
+        return [path]
+    clips = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith("file "):
+                clips.append(line[5:].strip()[1:-1].replace("'\\''", "'"))
+    return clips
+
+# First clip of a concat list, or the file itself
+def firstClip(path):
+    return listedClips(path)[0]
+
+def writeConcatList(path, inputPaths):
+    with open(path, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        f.write("\n".join(map(lambda f: "file '" + f.replace("'", "'\\''") + "'", inputPaths)) + "\n")
+
+# Probe cache, ffprobe results keyed by path + size + mtime, so that unchanged files are only probed once
+probeCache = {}
+probeCachePath = None
+probeCacheSize = 10000 # Maximum number of entries, the least recently used ones are evicted
+probeCacheLock = threading.Lock()
+
+def loadProbeCache(path, size=10000):
+    global probeCache, probeCachePath, probeCacheSize
+    probeCachePath, probeCacheSize = path, size
+    probeCache = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                probeCache = json.load(f)
+        except (OSError, ValueError):
+            print("Ignoring invalid probe cache: " + path)
+
+def saveProbeCache():
+    if probeCachePath is None:
+        return
+    with probeCacheLock:
+        # Evict the least recently used entries
+        if len(probeCache) > probeCacheSize:
+            for key in sorted(probeCache, key=lambda k: probeCache[k]["used"])[:len(probeCache) - probeCacheSize]:
+                del probeCache[key]
+        cacheDir = os.path.dirname(os.path.abspath(probeCachePath))
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        with open(probeCachePath + ".tmp", "w") as f:
+            json.dump(probeCache, f)
+        os.replace(probeCachePath + ".tmp", probeCachePath)
+
+def parseRate(rate):
+    numerator, _, denominator = rate.partition("/")
+    if float(denominator or 1) == 0:
+        return None
+    return float(numerator) / float(denominator or 1)
+
+def probeCacheKey(path):
+    stat = os.stat(path)
+    return path + "|" + str(stat.st_size) + "|" + str(stat.st_mtime_ns)
+
+# Returns width, height, duration, fps, codec and stream layout of a video, or None if it can't be probed
+def probeVideo(path):
+    path = os.path.abspath(firstClip(path))
+    key = probeCacheKey(path)
+    with probeCacheLock:
+        if key in probeCache:
+            probeCache[key]["used"] = time.time()
+            return probeCache[key]["probe"]
+    command = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = process.communicate()[0]
+    recordMetric("probe", path, time.perf_counter() - start)
+    if process.returncode != 0:
+        return None
+    info = json.loads(output.decode("utf-8", "ignore"))
+    streams = info.get("streams", [])
+    videoStreams = [s for s in streams if s.get("codec_type") == "video"]
+    video = videoStreams[0] if videoStreams else {}
+    duration = info.get("format", {}).get("duration")
+    probe = {"width": video.get("width"),
+             "height": video.get("height"),
+             "duration": float(duration) if duration else None,
+             "fps": parseRate(video.get("avg_frame_rate") or video.get("r_frame_rate") or "0/1"),
+             "codec": video.get("codec_name"),
+             "streams": [[s.get("codec_type"), s.get("codec_name")] for s in streams]}
+    with probeCacheLock:
+        probeCache[key] = {"probe": probe, "used": time.time()}
+    return probe
+
+# Total duration of a video or of the clips of a concat list, None if unknown
+def getVideoDuration(path):
+    duration = 0
+    for clip in listedClips(path):
+        probe = probeVideo(clip)
+        if probe is None or probe["duration"] is None:
+            return None
+        duration += probe["duration"]
+    return duration
+
 def getVideoWidth(path):
-    command = "ffmpeg -i " + path + " 2>&1 | perl -lane 'print $1 if /(\\d{4})x\\d{4}/'"
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-    return process.communicate()[0].decode("utf-8", "ignore").strip("\n")
+    probe = probeVideo(path)
+    return None if probe is None else probe["width"]
 
 def getVideoQuality(videoWidth):
-    if int(getVideoWidth(videoWidth)) < 3000:
+    width = getVideoWidth(videoWidth)
+    if width is None or width < 3000:
         return "30"
     else:
         return "35"
 
+# Static (parked, stationary) videos, where the picture is frozen most of the time
+# staticPolicy: what to do with them, "encode" (like the other videos, and don't analyze them), "fast" (faster preset & lower frame rate),
+# "timelapse" (keyframes only, at their original time) or "skip" (moved to the skipped directory, not compressed)
+staticPolicies = ["encode", "fast", "timelapse", "skip"]
+staticThreshold = 0.9 # Share of frozen time from which a video is static
+staticNoise = 0.003 # Difference below which 2 frames are the same, above the noise of the sensor
+staticMinFreeze = 10 # Seconds without change to count as frozen
+staticFps = 5 # Frame rate of the "fast" policy
+
+# Share of the time a clip is frozen, between 0 and 1, None if it can't be analyzed
+# Only the keyframes are decoded, downscaled, and compared by freezedetect, the result is cached with the probe
+def clipFrozenRatio(path):
+    path = os.path.abspath(path)
+    probe = probeVideo(path)
+    if probe is None or not probe["duration"]:
+        return None
+    key = probeCacheKey(path)
+    with probeCacheLock:
+        if key in probeCache and "frozen" in probeCache[key]:
+            return probeCache[key]["frozen"]
+    command = ['ffmpeg', '-hide_banner', '-nostats', '-skip_frame', 'nokey', '-i', path, '-an',
+               '-vf', 'scale=160:-2,freezedetect=n=' + str(staticNoise) + ':d=' + str(staticMinFreeze), '-f', 'null', '-']
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = process.communicate()[1]
+    recordMetric("analyze", path, time.perf_counter() - start)
+    if process.returncode != 0:
+        return None
+    # freezedetect logs the start of a freeze, then its end, unless it lasts until the end of the clip
+    frozen = 0
+    freezeStart = None
+    for line in output.decode("utf-8", "ignore").splitlines():
+        try:
+            if "lavfi.freezedetect.freeze_start:" in line:
+                freezeStart = float(line.rpartition(":")[2])
+            elif "lavfi.freezedetect.freeze_end:" in line and freezeStart is not None:
+                frozen += float(line.rpartition(":")[2]) - freezeStart
+                freezeStart = None
+        except ValueError:
+            pass
+    if freezeStart is not None:
+        frozen += probe["duration"] - freezeStart
+    ratio = max(0, min(1, frozen / probe["duration"]))
+    with probeCacheLock:
+        if key in probeCache:
+            probeCache[key]["frozen"] = ratio
+    return ratio
+
+# Share of the time a video or the clips of a concat list are frozen, None if unknown
+def frozenRatio(path):
+    frozen = 0
+    duration = 0
+    for clip in listedClips(path):
+        ratio = clipFrozenRatio(clip)
+        if ratio is None:
+            return None
+        frozen += ratio * probeVideo(clip)["duration"]
+        duration += probeVideo(clip)["duration"]
+    return frozen / duration if duration > 0 else None
+
+# Rate control mode, used when the quality isn't specified and targetBitrate (bits/s) or vmafFloor is set
+# Short samples of a video are encoded with the sampled qualities of the encoder, then the quality is chosen from the fitted curves:
+# the cheapest one above vmafFloor, but never above targetBitrate
+# The samples are kept in the probe cache, for each camera model, resolution, layout, encoder and preset
+targetBitrate = None
+vmafFloor = None
+rateSamples = 3 # Number of samples of a video
+rateSampleLength = 5 # Seconds
+
+# Duration of a sample, not cached since the samples are temporary files
+def sampleDuration(path):
+    process = subprocess.Popen(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return None
+    duration = json.loads(output.decode("utf-8", "ignore")).get("format", {}).get("duration")
+    return float(duration) if duration else None
+
+# VMAF of an encoded sample, against the same PIP filters applied to its sources, None if it can't be computed (e.g. no libvmaf)
+def vmafScore(encodedPath, mainFile, overlayFile):
+    vmafFilter = "libvmaf=shortest=1:n_threads=" + str(os.cpu_count() or 1)
+    command = ['ffmpeg', '-hide_banner', '-nostats']
+    if overlayFile is None:
+        command.extend(['-i', mainFile, '-i', encodedPath, '-lavfi', '[1:v][0:v]' + vmafFilter])
+    else:
+        command.extend(['-i', overlayFile, '-i', mainFile, '-i', encodedPath, '-filter_complex', pipFilter + "[reference];[2:v][reference]" + vmafFilter])
+    command.extend(['-f', 'null', '-'])
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = process.communicate()[1]
+    if process.returncode != 0:
+        return None
+    for line in output.decode("utf-8", "ignore").splitlines():
+        if "VMAF score:" in line:
+            try:
+                return float(line.rpartition(":")[2])
+            except ValueError:
+                pass
+    return None
+
+# Encodes samples of a video with the sampled qualities of the encoder
+# Returns the qualities, their bitrates (bits/s) and their VMAF (None unless vmafFloor is set), or None if sampling failed
+# vmafFailed is True when the VMAF couldn't be computed, e.g. without libvmaf, it isn't tried again for the other samples
+def sampleRates(mainFile, overlayFile, encoder, preset, threads, staticMask):
+    duration = getVideoDuration(mainFile)
+    if not duration:
+        return None
+    qualities = encoders[encoder]["quality"][2]
+    sizes = [0] * len(qualities)
+    scores = [[] for quality in qualities] if vmafFloor is not None else None
+    vmafFailed = False
+    sampledTime = 0
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix=".rate", dir=os.path.dirname(os.path.abspath(mainFile))) as sampleDir:
+        for i in range(rateSamples):
+            sampleStart = max(0, duration * (i + 1) / (rateSamples + 1) - rateSampleLength / 2)
+            # Cut the sources at the keyframe before the sample, without encoding them, nor copying the data (GPS) tracks
+            sources = []
+            for source in [mainFile] if overlayFile is None else [mainFile, overlayFile]:
+                samplePath = os.path.join(sampleDir, "source" + str(i) + str(len(sources)) + ".mp4")
+                command = ffmpegArgs + ['-ss', "%.3f" % sampleStart] + inputArgs(source) + ['-t', str(rateSampleLength), '-map', '0:v:0', '-map', '0:a?', '-c', 'copy', samplePath]
+                if runFfmpeg(command, samplePath) != 0:
+                    return None
+                sources.append(samplePath)
+            sampleLength = sampleDuration(sources[0])
+            if not sampleLength:
+                return None
+            sampledTime += sampleLength
+            sampleOverlay = sources[1] if overlayFile is not None else None
+            for j, quality in enumerate(qualities):
+                encodedPath = os.path.join(sampleDir, "encoded" + str(i) + str(j) + ".mp4")
+                if runFfmpeg(compressCommand(sources[0], sampleOverlay, encodedPath, encoder, quality, preset, threads, staticMask), encodedPath) != 0:
+                    return None
+                sizes[j] += os.path.getsize(encodedPath)
+                if scores is not None and not vmafFailed:
+                    score = vmafScore(encodedPath, sources[0], sampleOverlay)
+                    vmafFailed = score is None
+                    scores[j].append(score)
+    recordMetric("sample", mainFile, time.perf_counter() - start, samples=rateSamples, qualities=qualities)
+    vmaf = None
+    if vmafFailed:
+        print("Couldn't compute the VMAF of the samples, is ffmpeg built with libvmaf?")
+    elif scores is not None:
+        vmaf = [sum(score) / len(score) for score in scores]
+    return {"qualities": qualities, "bitrates": [size * 8 / sampledTime for size in sizes], "vmaf": vmaf, "vmafFailed": vmafFailed}
+
+# Least squares line through the points, returns its intercept and slope
+def linearFit(xs, ys):
+    meanX, meanY = sum(xs) / len(xs), sum(ys) / len(ys)
+    slope = sum((x - meanX) * (y - meanY) for x, y in zip(xs, ys)) / sum((x - meanX) ** 2 for x in xs)
+    return meanY - slope * meanX, slope
+
+# Quality meeting the targets according to the samples, and its predicted bitrate and VMAF (None without vmafFloor)
+# The bitrate is exponential in the quality, the VMAF linear, the curves are extrapolated up to one step beyond the samples,
+# within the range of the encoder's option
+def rateQuality(rates, encoder):
+    qualities = rates["qualities"]
+    step = abs(qualities[1] - qualities[0])
+    low, high = encoders[encoder]["quality"][3]
+    candidates = range(max(low, min(qualities) - step), min(high, max(qualities) + step) + 1)
+    intercept, slope = linearFit(qualities, [math.log(max(1, bitrate)) for bitrate in rates["bitrates"]])
+    bitrate = lambda quality: math.exp(intercept + slope * quality)
+    vmaf = None
+    if vmafFloor is not None and rates["vmaf"] is not None:
+        vmafIntercept, vmafSlope = linearFit(qualities, rates["vmaf"])
+        vmaf = lambda quality: vmafIntercept + vmafSlope * quality
+    quality = None
+    if vmaf is not None:
+        aboveFloor = [q for q in candidates if vmaf(q) >= vmafFloor]
+        quality = min(aboveFloor, key=bitrate) if aboveFloor else max(candidates, key=bitrate)
+    if targetBitrate is not None and (quality is None or bitrate(quality) > targetBitrate):
+        withinBudget = [q for q in candidates if bitrate(q) <= targetBitrate]
+        quality = max(withinBudget, key=bitrate) if withinBudget else min(candidates, key=bitrate)
+    if quality is None:
+        return None
+    return quality, bitrate(quality), vmaf(quality) if vmaf is not None else None
+
+# Quality of a video in rate control mode, 0 (the default quality) if it can't be sampled
+def adaptiveQuality(mainFile, overlayFile, encoder, preset, threads, staticMask, model, outputPath):
+    probe = probeVideo(mainFile)
+    if probe is None:
+        return 0
+    key = "|".join(["rate", model, str(probe["width"]) + "x" + str(probe["height"]), "single" if overlayFile is None else "pip", encoder, str(preset)])
+    with probeCacheLock:
+        entry = probeCache.get(key)
+        # Sampled without VMAF, unless it has already failed, then the bitrates are enough
+        rates = entry["rates"] if entry is not None and (vmafFloor is None or entry["rates"]["vmaf"] is not None or entry["rates"].get("vmafFailed")) else None
+    if rates is None:
+        print("Sampling qualities " + ", ".join(map(str, encoders[encoder]["quality"][2])) + " \t" + outputPath)
+        rates = sampleRates(mainFile, overlayFile, encoder, preset, threads, staticMask)
+        if rates is None:
+            print("Couldn't sample the video, using the default quality \t" + outputPath)
+            return 0
+        with probeCacheLock:
+            probeCache[key] = {"rates": rates, "used": time.time()}
+    else:
+        with probeCacheLock:
+            probeCache[key]["used"] = time.time()
+    choice = rateQuality(rates, encoder)
+    if choice is None:
+        return 0
+    quality, bitrate, vmaf = choice
+    print("Rate control: " + encoders[encoder]["quality"][0] + " " + str(quality) + " (" + str(int(bitrate / 1000)) + " kb/s" + (", VMAF " + str(round(vmaf, 1)) if vmaf is not None else "") + ") \t" + outputPath)
+    return quality
+
+# Keyframes of a video or of a concat list, as (packet index, time) in decoding order, time is relative to the first packet
+# Only the packets are listed, nothing is decoded, empty if it can't be probed
+def getKeyframes(path):
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0'] + inputArgs(path)
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = process.communicate()[0]
+    recordMetric("probe", path, time.perf_counter() - start, keyframes=True)
+    if process.returncode != 0:
+        return []
+    times = []
+    keyframes = []
+    for index, line in enumerate(output.decode("utf-8", "ignore").splitlines()):
+        ptsTime, _, flags = line.partition(",")
+        try:
+            times.append(float(ptsTime))
+        except ValueError: # N/A
+            continue
+        if flags.startswith("K"):
+            keyframes.append((index, times[-1]))
+    if len(times) == 0:
+        return []
+    return [(index, t - min(times)) for index, t in keyframes]
+
+# Manifest of the groups of clips in an output directory, so that reruns can resume with an indexed lookup
+# States: discovered -> concatenated -> encoding -> done, or failed, or skipped (static video)
+manifests = {}
+manifestLock = threading.Lock()
+
+def openManifest(outputDir):
+    outputDir = os.path.abspath(outputDir)
+    if outputDir not in manifests:
+        if not os.path.exists(outputDir):
+            os.makedirs(outputDir)
+        db = sqlite3.connect(os.path.join(outputDir, ".manifest.sqlite"), check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY, state TEXT NOT NULL, inputs TEXT NOT NULL DEFAULT '[]', fingerprint TEXT NOT NULL DEFAULT '', output TEXT, updated REAL)")
+        db.commit()
+        manifests[outputDir] = db
+    return manifests[outputDir]
+
+def closeManifest(outputDir):
+    with manifestLock:
+        db = manifests.pop(os.path.abspath(outputDir), None)
+        if db is not None:
+            db.close()
+
+def manifestGet(outputDir, name):
+    with manifestLock:
+        row = openManifest(outputDir).execute("SELECT state, inputs, fingerprint, output FROM groups WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return None
+    return {"state": row[0], "inputs": json.loads(row[1]), "fingerprint": row[2], "output": row[3]}
+
+def manifestSet(outputDir, name, state, inputs=None, fingerprint=None, output=None):
+    with manifestLock:
+        db = openManifest(outputDir)
+        db.execute("INSERT INTO groups (name, state, updated) VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET state = excluded.state, updated = excluded.updated", (name, state, time.time()))
+        if inputs is not None:
+            db.execute("UPDATE groups SET inputs = ?, fingerprint = ? WHERE name = ?", (json.dumps(inputs), fingerprint, name))
+        if output is not None:
+            db.execute("UPDATE groups SET output = ? WHERE name = ?", (output, name))
+        db.commit()
+
+# Identifies the clips of a group, if any of them changes, the group has to be processed again
+def inputFingerprint(inputPaths):
+    fingerprint = []
+    for inputPath in inputPaths:
+        stat = os.stat(inputPath)
+        fingerprint.append([os.path.basename(inputPath), stat.st_size, stat.st_mtime_ns])
+    return json.dumps(fingerprint)
+
 def filenamesInDir(dir):
     filenames = [f for f in os.listdir(dir) if not f.startswith(".") and os.path.isfile(os.path.join(dir, f))]
     filenames.sort()
     return filenames
 
-def compressVideos(outputDir, processor, codec, quality, model):
+# Number of encoders to run at the same time
+# "auto" lets each CPU encoder have ~8 threads, which is where a single 1080p/4K stream stops scaling
+def jobCount(jobs, encoder, jobTotal):
+    if jobs == "auto":
+        if encoders[encoder]["threads"] is not None: # CPU
+            count = max(1, (os.cpu_count() or 1) // 8)
+        else: # GPU, the number of concurrent sessions is limited by the hardware
+            count = 2
+    else:
+        count = max(1, int(jobs))
+    return max(1, min(count, jobTotal))
+
+# Split the CPU threads between the workers, so that they don't oversubscribe the machine
+# Returns None when there is a single worker, encoders then use all the threads
+def threadsPerJob(workers):
+    if workers <= 1:
+        return None
+    return max(1, (os.cpu_count() or 1) // workers)
+
+def x265Params(threads):
+    return "log-level=error" + ("" if threads is None else ":pools=" + str(threads))
+
+# Video encoding parameters of an encoder profile
+# sourceFile is used to choose the quality when it's not specified
+def encoderArgs(encoder, quality, preset, threads, sourceFile):
+    profile = encoders[encoder]
+    command = list(profile["args"])
+    if profile["preset"] is not None:
+        command.extend([profile["preset"][0], str(preset if preset is not None else profile["preset"][1])])
+    qualityOption, defaultQuality = profile["quality"][:2]
+    if quality != 0:
+        command.extend([qualityOption, str(quality)])
+    else:
+        command.extend([qualityOption, defaultQuality if defaultQuality is not None else getVideoQuality(sourceFile)])
+    if profile["threads"] == "x265":
+        command.extend(['-x265-params', x265Params(threads)])
+    elif profile["threads"] == "ffmpeg" and threads is not None:
+        command.extend(['-threads', str(threads)])
+    return command
+
+# ffmpeg command compressing a video, overlayFile is None if it's not a PIP video
+# staticMask uses a pre-generated mask for the rounded corners of the PIP video
+# overlayStart (in seconds) skips the beginning of the overlay video, frames limits the number of frames to encode
+# The overlay video is decoded from the keyframe before overlayStart, so that the first frame of the main video has a PIP
+# audio is False to leave out the audio, staticPolicy is "fast" or "timelapse" to take the cheaper path of static videos
+def compressCommand(mainFile, overlayFile, outputPath, encoder, quality, preset, threads, staticMask=False, overlayStart=None, frames=None, audio=True, staticPolicy=None):
+    command = ffmpegArgs[:]
+    # Only decode the keyframes of a timelapse, and keep their original time
+    mainArgs = ['-skip_frame', 'nokey'] if staticPolicy == "timelapse" else []
+    overlayArgs = mainArgs + (['-noaccurate_seek', '-ss', "%.6f" % overlayStart] if overlayStart else [])
+    # Lower the frame rate of the inputs, before the PIP filters
+    fpsFilter = "fps=" + str(staticFps) if staticPolicy == "fast" else None
+    maskPath = pipMask(overlayFile, os.path.dirname(os.path.abspath(overlayFile))) if overlayFile is not None and staticMask else None
+    if overlayFile is not None:
+        graph = pipMaskFilter if maskPath is not None else pipFilter
+        if fpsFilter is not None:
+            graph = "[0]" + fpsFilter + "[rear];[1]" + fpsFilter + "[front];" + graph.replace("[0]", "[rear]", 1).replace("[1]", "[front]", 1)
+        command.extend(overlayArgs + inputArgs(overlayFile) + mainArgs + inputArgs(mainFile) + (['-i', maskPath] if maskPath is not None else []) + ['-filter_complex', graph])
+    else:
+        command.extend(mainArgs + inputArgs(mainFile) + (['-vf', fpsFilter] if fpsFilter is not None else []))
+    command.extend(audioArgs if audio else ['-an'])
+    if frames is not None:
+        command.extend(['-frames:v', str(frames)])
+    if staticPolicy == "timelapse":
+        command.extend(['-fps_mode', 'vfr'])
+    if staticPolicy == "fast" and encoders[encoder]["preset"] is not None:
+        preset = encoders[encoder]["preset"][2]
+    command.extend(encoderArgs(encoder, quality, preset, threads, mainFile))
+    command.append(outputPath)
+    return command
+
+# Structured log of the time spent in each stage (probe, concat, encode, move), one JSON object per line
+metricsPath = None
+metricsLock = threading.Lock()
+
+def setMetricsFile(path):
+    global metricsPath
+    metricsPath = path
+
+def recordMetric(stage, name, seconds, **values):
+    if metricsPath is None:
+        return
+    entry = {"time": round(time.time(), 3), "stage": stage, "name": name, "seconds": round(seconds, 3)}
+    entry.update(values)
+    with metricsLock:
+        with open(metricsPath, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+# Progress of the running ffmpeg processes, reported every progressInterval seconds
+# label -> duration, outTime (seconds of media processed), fps, speed, size (bytes written)
+progress = {}
+progressInterval = 10
+progressLock = threading.Lock()
+lastProgressReport = 0
+
+def formatSeconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+def addProgress(label, duration):
+    with progressLock:
+        progress[label] = {"duration": duration, "outTime": 0, "fps": 0, "speed": 0, "size": 0, "running": False}
+
+def removeProgress(label):
+    with progressLock:
+        progress.pop(label, None)
+
+def updateProgress(label, status):
+    global lastProgressReport
+    with progressLock:
+        entry = progress.get(label)
+        if entry is None:
+            return
+        entry["running"] = status.get("progress") == "continue"
+        try:
+            entry["outTime"] = max(0, int(status.get("out_time_us", "0"))) / 1000000
+        except ValueError: # N/A
+            pass
+        try:
+            entry["fps"] = float(status.get("fps", "0"))
+            entry["speed"] = float(status.get("speed", "0x").rstrip("x"))
+        except ValueError: # N/A
+            pass
+        if status.get("total_size", "N/A").isdigit():
+            entry["size"] = int(status["total_size"])
+        if time.time() - lastProgressReport < progressInterval:
+            return
+        lastProgressReport = time.time()
+        # Per job
+        for jobLabel, jobEntry in progress.items():
+            if not jobEntry["running"]:
+                continue
+            line = "Progress \t" + os.path.basename(jobLabel)
+            if jobEntry["duration"]:
+                line += " \t" + str(min(100, int(jobEntry["outTime"] * 100 / jobEntry["duration"]))) + "%"
+                if jobEntry["speed"] > 0:
+                    line += " ETA " + formatSeconds((jobEntry["duration"] - jobEntry["outTime"]) / jobEntry["speed"])
+            line += " \t" + str(round(jobEntry["fps"], 1)) + " fps " + str(round(jobEntry["speed"], 2)) + "x " + str(round(jobEntry["size"] / 1048576, 1)) + " MB"
+            print(line)
+        # Aggregate, including the jobs which haven't started yet
+        running = [e for e in progress.values() if e["running"]]
+        speed = sum(e["speed"] for e in running)
+        line = "Progress \tTotal \t" + str(len(running)) + "/" + str(len(progress)) + " running \t" + str(round(sum(e["fps"] for e in running), 1)) + " fps " + str(round(speed, 2)) + "x " + str(round(sum(e["size"] for e in progress.values()) / 1048576, 1)) + " MB"
+        if speed > 0 and all(e["duration"] for e in progress.values()):
+            line += " ETA " + formatSeconds(sum(e["duration"] - e["outTime"] for e in progress.values()) / speed)
+        print(line)
+
+# Largest resident set (KB) of the ffmpeg processes run by runFfmpeg() since resetPeakRss(), 0 if unknown (Windows)
+peakRss = 0
+peakRssLock = threading.Lock()
+
+def resetPeakRss():
+    global peakRss
+    with peakRssLock:
+        peakRss = 0
+
+# Waits for a process, and records its own peak memory, unlike RUSAGE_CHILDREN which covers all the children so far
+def waitProcess(process):
+    global peakRss
+    if not hasattr(os, "wait4"):
+        return process.wait()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    with peakRssLock:
+        # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+        peakRss = max(peakRss, usage.ru_maxrss // (1024 if sys.platform == "darwin" else 1))
+    return process.returncode
+
+# Runs ffmpeg and parses its "-progress pipe:1" output, returns the return code
+def runFfmpeg(command, label):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    status = {}
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        status[key] = value
+        # Each block of progress values ends with "progress=continue", or "progress=end"
+        if key == "progress":
+            updateProgress(label, status)
+            status = {}
+    return waitProcess(process)
+
+# What happens to the staged sources of a compressed video: moved to the completed directory (keep),
+# deleted (the original clips are still on the card), or moved to archiveDir, e.g. on another volume
+retentionPolicies = ["keep", "delete", "archive"]
+retention = "keep"
+archiveDir = None
+
+# A rename on the same volume, else a copy (with sendfile/fcopyfile) and a delete
+def retireInputs(inputPaths, completedDir):
+    for inputPath in inputPaths:
+        if retention == "delete":
+            os.remove(inputPath)
+        else:
+            targetDir = archiveDir if retention == "archive" else completedDir
+            if not os.path.exists(targetDir):
+                os.makedirs(targetDir)
+            shutil.move(inputPath, targetDir)
+
+def jobNames(job):
+    return [clipName(os.path.basename(inputPath)) for inputPath in job["inputs"]]
+
+# Updates the manifest once a job is over, and retires its sources, only if it has been encoded
+def finishJob(job, completedDir, returncode):
+    for name in jobNames(job):
+        manifestSet(job["outputDir"], name, "done" if returncode == 0 else "failed")
+    if returncode == 0:
+        start = time.perf_counter()
+        retireInputs(job["inputs"], completedDir)
+        recordMetric("move", job["output"], time.perf_counter() - start, retention=retention)
+
+def runJob(job, completedDir):
+    if "segmentArgs" in job and splitSource(job):
+        return joinSegments(job, completedDir, [encodeSegment(job, task) for task in segmentTasks(job)])
+    for name in jobNames(job):
+        manifestSet(job["outputDir"], name, "encoding", output=job["output"])
+    start = time.perf_counter()
+    returncode = runFfmpeg(job["command"], job["output"])
+    seconds = time.perf_counter() - start
+    outputSize = os.path.getsize(job["output"]) if os.path.exists(job["output"]) else 0
+    recordMetric("encode", job["output"], seconds,
+                 returncode=returncode,
+                 duration=job["duration"],
+                 speed=round(job["duration"] / seconds, 3) if job["duration"] and seconds > 0 else None,
+                 outputSize=outputSize,
+                 freeSpace=shutil.disk_usage(job["outputDir"]).free)
+    removeProgress(job["output"])
+    finishJob(job, completedDir, returncode)
+    return returncode
+
+# Plans the segments of a job and cuts its main video into pieces, returns False if it has to be encoded in one piece instead
+# The pieces are a copy of the main video, they need as much free space, even in stream mode
+def splitSource(job):
+    splitJob(job, *job.pop("segmentArgs"))
+    if "segments" not in job: # Not enough keyframes
+        return False
+    # Segments of an interrupted run can't be trusted, split & encode them again
+    shutil.rmtree(job["workDir"], ignore_errors=True)
+    os.makedirs(job["workDir"])
+    needed = sum(os.path.getsize(clip) for clip in listedClips(job["inputs"][0]))
+    free = shutil.disk_usage(job["workDir"]).free
+    if needed > free:
+        print("Not enough free space to split (" + formatSize(needed) + " needed, " + formatSize(free) + " free), compress in one piece \t" + job["output"])
+        unsplitJob(job)
+        return False
+    start = time.perf_counter()
+    returncode = runFfmpeg(job["split"], job["output"])
+    recordMetric("split", job["output"], time.perf_counter() - start, returncode=returncode, segments=len(job["segments"]))
+    if returncode != 0 or not all(map(os.path.exists, job["pieces"])):
+        print("Failed to split, compress in one piece \t" + job["output"])
+        unsplitJob(job)
+        return False
+    for listPath, piecePaths in job["lists"].items():
+        writeConcatList(listPath, piecePaths)
+    print("Split into " + str(len(job["segments"])) + " segments \t" + job["output"])
+    # Report the progress of the segments instead of the whole video
+    removeProgress(job["output"])
+    for task in segmentTasks(job):
+        addProgress(task["output"], task["duration"])
+    return True
+
+# Back to a job encoded in one piece
+def unsplitJob(job):
+    shutil.rmtree(job["workDir"], ignore_errors=True)
+    for key in ["segments", "audio", "split", "pieces", "lists", "workDir"]:
+        job.pop(key, None)
+
+# Encoding tasks of a segmented job, the video segments and the audio
+def segmentTasks(job):
+    return job["segments"] + ([job["audio"]] if "audio" in job else [])
+
+def encodeSegment(job, task):
+    for name in jobNames(job):
+        manifestSet(job["outputDir"], name, "encoding", output=job["output"])
+    start = time.perf_counter()
+    returncode = runFfmpeg(task["command"], task["output"])
+    seconds = time.perf_counter() - start
+    recordMetric("encode", task["output"], seconds,
+                 returncode=returncode,
+                 duration=task["duration"],
+                 speed=round(task["duration"] / seconds, 3) if task["duration"] and seconds > 0 else None,
+                 outputSize=os.path.getsize(task["output"]) if os.path.exists(task["output"]) else 0)
+    removeProgress(task["output"])
+    return returncode
+
+# Joins the encoded segments of a job and its audio, returncodes are the ones of the segment tasks
+# The segments have the same encoding parameters, so the concat demuxer can join them with "-c copy",
+# and their timestamps are rebuilt from the segment durations, continuing from one segment to the next
+def joinSegments(job, completedDir, returncodes):
+    returncode = next((returncode for returncode in returncodes if returncode != 0), 0)
+    if returncode == 0:
+        listPath = os.path.join(job["workDir"], "segments" + concatListExt)
+        writeConcatList(listPath, [os.path.abspath(segment["output"]) for segment in job["segments"]])
+        command = ffmpegArgs + inputArgs(listPath)
+        if "audio" in job:
+            command.extend(['-i', job["audio"]["output"], '-map', '0:v', '-map', '1:a'])
+        command.extend(['-c', 'copy', job["output"]])
+        addProgress(job["output"], job["duration"])
+        start = time.perf_counter()
+        returncode = runFfmpeg(command, job["output"])
+        removeProgress(job["output"])
+        recordMetric("join", job["output"], time.perf_counter() - start,
+                     returncode=returncode,
+                     segments=len(job["segments"]),
+                     outputSize=os.path.getsize(job["output"]) if os.path.exists(job["output"]) else 0,
+                     freeSpace=shutil.disk_usage(job["outputDir"]).free)
+    shutil.rmtree(job["workDir"], ignore_errors=True)
+    finishJob(job, completedDir, returncode)
+    return returncode
+
+# Progress of a job, the one of a segmented job is replaced by its segment tasks once it's split
+def addJobProgress(job):
+    addProgress(job["output"], job["duration"])
+
+# Queues a job in the encoder pool, returns the future of its return code
+# A segmented job is driven by the finisher pool, which only waits for the encoder pool and runs the "-c copy" join:
+# the split is queued first, then the segments as separate tasks, so that they're encoded in parallel
+def submitJob(job, completedDir, encoderPool, finisherPool):
+    if "segmentArgs" not in job:
+        return encoderPool.submit(runJob, job, completedDir)
+    def runSegments():
+        if not encoderPool.submit(splitSource, job).result():
+            return encoderPool.submit(runJob, job, completedDir).result()
+        futures = [encoderPool.submit(encodeSegment, job, task) for task in segmentTasks(job)]
+        return joinSegments(job, completedDir, [future.result() for future in futures])
+    return finisherPool.submit(runSegments)
+
+def runJobs(jobs, workers, completedDir):
+    for job in jobs:
+        addJobProgress(job)
+    if workers <= 1:
+        for job in jobs:
+            print(job["description"] + " \t" + job["output"])
+            returncode = runJob(job, completedDir)
+            if returncode != 0:
+                print("Failed (" + str(returncode) + ") \t" + job["output"])
+        return
+    for job in jobs:
+        print(job["description"] + " \t" + job["output"])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as encoderPool:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as finisherPool:
+            futures = [submitJob(job, completedDir, encoderPool, finisherPool) for job in jobs]
+            returncodes = [future.result() for future in futures]
+    # Summary, in the same order as the jobs
+    for job, returncode in zip(jobs, returncodes):
+        print(("Done" if returncode == 0 else "Failed (" + str(returncode) + ")") + " \t" + job["output"])
+
+# Staged videos of the output directory to compress, None if there isn't any
+# Each item is (mainFile, overlayFile), overlayFile is None if it's not a PIP video
+def findSources(outputDir, model):
+    clips = indexClips(filenamesInDir(outputDir), model, outputDir) if os.path.exists(outputDir) else {}
+    if len(clips) == 0:
+        print("Didn't find any file to process for " + cameraModels[model]["description"] + ": " + outputDir)
+        return None
+    # If both A & B are found (10 seconds tolerance), compress them to the same PIP video
+    sources = []
+    for front, rear in pairClips(clips.get("A", []), clips.get("B", []), 10):
+        if front is not None and rear is not None:
+            sources.append((os.path.join(outputDir, front.name), os.path.join(outputDir, rear.name)))
+        else: # If only A or B is found, compress it only
+            sources.append((os.path.join(outputDir, (front or rear).name), None))
+    return sources
+
+# Keyframes where the segments of a video start, about segmentLength seconds apart
+# The last segment is at least half as long, instead of a few seconds at the end of the drive
+def segmentStarts(path, duration, segmentLength):
+    starts = []
+    for index, keyframe in getKeyframes(path):
+        if len(starts) == 0 or (keyframe - starts[-1][1] >= segmentLength and duration - keyframe >= segmentLength / 2):
+            starts.append((index, keyframe))
+    return starts
+
+# Plans the segments of a job, encoded separately (video only), the audio is encoded in one piece,
+# then joinSegments() joins them with the concat demuxer, without re-encoding
+# Only the keyframes are read here, the main video is cut by splitSource()
+# The main video is cut without re-encoding at the keyframe packets, and each segment encodes the exact number of frames of its piece,
+# so that every frame is in exactly one segment and the video stays in sync with the audio
+# The next piece is appended to the input of a segment, because the PIP filters drop the last few frames of their input
+# The overlay video is read from the start of the segment until its end, it doesn't set the length of the PIP video
+def splitJob(job, encoder, quality, preset, threads, staticMask, segmentLength):
+    mainFile = job["inputs"][0]
+    overlayFile = job["inputs"][1] if len(job["inputs"]) > 1 else None
+    starts = segmentStarts(mainFile, job["duration"], segmentLength)
+    if len(starts) < 2:
+        return
+    workDir = os.path.join(os.path.dirname(job["output"]), "." + os.path.basename(job["output"]) + ".segments")
+    sourcePaths = [os.path.join(workDir, "source_" + str(i).zfill(3) + ".mp4") for i in range(len(starts))]
+    job["split"] = ffmpegArgs + inputArgs(mainFile) + ['-map', '0:v:0', '-c', 'copy',
+                                                       '-f', 'segment', '-segment_frames', ",".join(str(index) for index, _ in starts[1:]), '-reset_timestamps', '1',
+                                                       os.path.join(workDir, "source_%03d.mp4")]
+    job["pieces"] = sourcePaths
+    # The pieces don't exist yet, choose the quality from the main video
+    if quality == 0 and encoders[encoder]["quality"][1] is None:
+        quality = getVideoQuality(mainFile)
+    segments = []
+    # Concat lists of the segments reading the next piece too, written once the pieces exist
+    job["lists"] = {}
+    for i, (index, segmentStart) in enumerate(starts):
+        outputPath = os.path.join(workDir, os.path.basename(job["output"])[:-4] + "." + str(i).zfill(3) + ".mp4")
+        if i + 1 < len(starts):
+            inputPath = os.path.join(workDir, "source_" + str(i).zfill(3) + concatListExt)
+            job["lists"][inputPath] = [os.path.abspath(path) for path in sourcePaths[i:i + 2]]
+            frames = starts[i + 1][0] - index
+            duration = starts[i + 1][1] - segmentStart
+        else:
+            inputPath = sourcePaths[i]
+            frames = None
+            duration = job["duration"] - segmentStart
+        segments.append({"output": outputPath,
+                         "command": compressCommand(inputPath, overlayFile, outputPath, encoder, quality, preset, threads, staticMask, segmentStart, frames, False),
+                         "duration": duration})
+    job["workDir"] = workDir
+    job["segments"] = segments
+    # Same inputs as the full command, so that ffmpeg picks the same audio stream
+    audioStreams = [stream for inputPath in job["inputs"] for stream in ((probeVideo(inputPath) or {}).get("streams") or []) if stream[0] == "audio"]
+    if len(audioStreams) > 0:
+        outputPath = os.path.join(workDir, os.path.basename(job["output"])[:-4] + ".m4a")
+        inputs = inputArgs(overlayFile) + inputArgs(mainFile) if overlayFile is not None else inputArgs(mainFile)
+        job["audio"] = {"output": outputPath,
+                        "command": ffmpegArgs + inputs + ['-vn'] + audioArgs + [outputPath],
+                        "duration": job["duration"]}
+
+# Builds the compression jobs of the sources, skipping the ones which are already done
+# Videos longer than segmentLength (in seconds) are split into segments encoded in parallel, 0 to never split them
+# Static videos are analyzed and handled according to staticPolicy, unless it's "encode"
+def buildJobs(sources, outputDir, encoder, quality, model, threads, preset=None, staticMask=False, segmentLength=0, staticPolicy="encode"):
     completedDir = os.path.join(outputDir, 'completed')
     if not os.path.exists(completedDir):
         os.makedirs(completedDir)
-    if model == "d5":
-        filenames = list(filter(lambda f: f.endswith("a.MP4") or f.endswith("b.MP4"), filenamesInDir(outputDir)))
-        if len(filenames) == 0:
-            print("Didn't find any file to process for PAPAGO D5: " + outputDir)
-            return
-        skipNextFile = False
-        for i in range(len(filenames)):
-            if skipNextFile:
-                skipNextFile = False
+    jobList = []
+    for mainFile, overlayFile in sources:
+        outputPath = clipName(mainFile)[:-cameraModels[model]["stemLength"]] + encoders[encoder]["suffix"] + ".mp4"
+        jobList.append({"outputDir": outputDir,
+                        "description": "Compressing video" if overlayFile is None else "Compressing PIP video",
+                        "output": outputPath,
+                        "command": compressCommand(mainFile, overlayFile, outputPath, encoder, quality, preset, threads, staticMask),
+                        "inputs": [mainFile] if overlayFile is None else [mainFile, overlayFile],
+                        "duration": getVideoDuration(mainFile)})
+    # Check the manifest for the jobs which have been interrupted
+    pendingJobs = []
+    for job in jobList:
+        states = [(manifestGet(outputDir, clipName(os.path.basename(inputPath))) or {}).get("state") for inputPath in job["inputs"]]
+        if os.path.exists(job["output"]):
+            # Compressed, but the sources haven't been moved
+            if all(state == "done" for state in states):
+                retireInputs(job["inputs"], completedDir)
                 continue
-            # Look for related front(A)/back(B) videos
-            filenameCurr = filenames[i]
-            filenameNext = filenames[i] if (i == len(filenames) - 1) else filenames[i + 1]
-            dtCurr = getDatetime(filenameCurr, model)
-            dtNext = getDatetime(filenameNext, model)
-            interval = abs((dtCurr - dtNext).total_seconds())
-            # If both A & B are found (10 seconds tolerance), compress them to the same PIP video
-            if filenameCurr != filenameNext and interval <= 10:
-                mainFile = os.path.join(outputDir, (filenameCurr if filenameCurr.endswith("a.MP4") else filenameNext))
-                outputPath = mainFile[:-9]
-                overlayFile = os.path.join(outputDir, (filenameNext if filenameNext.endswith("b.MP4") else filenameCurr))
-                # Common parameters
-                command = ['ffmpeg', '-stats', '-loglevel', 'error',
-                            '-i', overlayFile,
-                            '-i', mainFile,
-                            '-filter_complex', '[0]crop=iw:ih*3/4:0:ih/8[overlay];[overlay]hflip[overlay];[overlay]format=yuva420p,geq=lum=\'p(X,Y)\':a=\'if(gt(abs(W/2-X),W/2-32)*gt(abs(H/2-Y),H/2-32),if(lte(hypot(32-(W/2-abs(W/2-X)),32-(H/2-abs(H/2-Y))),32),255,0),255)\'[overlay];[overlay][1]scale2ref=iw/3:ow/mdar[overlay][main];[main][overlay]overlay=main_w/3:main_h/50',
-                            '-c:a', 'aac',
-                            '-b:a', '64k',
-                            '-ac', '1']
-                if codec == 0: # HEVC
-                    command.extend(['-vtag', 'hvc1'])
-                    # Add processor-specific encoding parameters
-                    if processor == 0: # CPU
-                        command.extend([
-                            '-c:v', 'libx265',
-                            '-preset', '5',
-                            '-x265-params', 'log-level=error',
-                            '-g', '240',
-                            '-b:v', '0',           # Let CRF control bitrate
-                            '-crf', str(quality if quality != 0 else getVideoQuality(mainFile)) # Constant Rate Factor (0-63, lower = better quality)
-                            ])
-                    elif processor == 1: # Nvidia GPU
-                        command.extend([
-                            '-c:v', 'hevc_nvenc',
-                            '-rc', 'constqp',
-                            '-qp', str(quality if quality != 0 else 37)
-                            ])
-                    elif processor == 2: # Apple GPU
-                        command.extend([
-                            '-c:v', 'hevc_videotoolbox', 
-                            '-q:v', str(quality if quality != 0 else 25),
-                            '-g', '240'
-                            ])
-                    outputPath = outputPath + ".mp4"
-                    command.append(outputPath)
-                elif codec == 1: # AV1
-                    command.extend(['-c:v', 'libaom-av1',
-                                    '-cpu-used', '8', # Speed preset (0-8, lower = better quality but slower)
-                                    '-row-mt', '1', # Enable row-based multithreading
-                                    '-tiles', '2x2', # Split encoding into 2x2 tiles for better parallelization
-                                    '-preset', '8', # Encoding speed preset (0-13, higher = faster)
-                                    '-svtav1-params', 'fast-decode=1', # Enable fast decoding mode
-                                    '-crf', str(quality if quality != 0 else 55), # Constant Rate Factor (0-63, lower = better quality)
-                                    '-b:v', '0' # Let CRF control bitrate
-                                    ])
-                    outputPath = outputPath + "_AV1.mp4"
-                    command.append(outputPath)
-                print("Compressing PIP video \t" + outputPath)
-                process = subprocess.Popen(command, stdout=subprocess.PIPE)
-                process.wait()
-                shutil.move(mainFile, completedDir)
-                shutil.move(overlayFile, completedDir)
-                skipNextFile = True
-            # If only A or B is found, and file still exists, compress it only
-            elif filenameCurr.endswith("a.MP4") or filenameCurr.endswith("b.MP4"):
-                filePath = os.path.join(outputDir, filenameCurr)
-                outputPath = filePath[:-9]
-                # Common ffmpeg parameters
-                command = ['ffmpeg', '-stats', '-loglevel', 'error',
-                         '-i', filePath,
-                         '-c:a', 'aac',
-                         '-b:a', '64k',
-                         '-ac', '1']
-                if codec == 0: # HEVC
-                    command.extend(['-vtag', 'hvc1'])
-                    command.extend([
-                        # '-vf', 'scale=1920:-1', # Resize video to 1920x1080
-                        ])
-                    # Add processor-specific encoding parameters
-                    if processor == 0:  # CPU
-                        command.extend([
-                            '-c:v', 'libx265',
-                            '-preset', '5',
-                            '-x265-params', 'log-level=error',
-                            '-g', '240',
-                            '-b:v', '0', # Let CRF control bitrate
-                            '-crf', str(quality if quality != 0 else getVideoQuality(filePath)) # Constant Rate Factor (0-63, lower = better quality)
-                            ])
-                    elif processor == 1:  # Nvidia GPU
-                        command.extend([
-                            '-c:v', 'hevc_nvenc',
-                            '-rc', 'constqp',
-                            '-qp', str(quality if quality != 0 else 37)
-                            ])
-                    elif processor == 2:  # Apple GPU
-                        command.extend([
-                            '-c:v', 'hevc_videotoolbox',
-                            '-q:v', str(quality if quality != 0 else 25),
-                            '-g', '240'
-                            ])
-                    outputPath = outputPath + ".mp4"
-                    command.append(outputPath)
-                else:
-                    command.extend([
-                        # '-vf', 'scale=1920:-1', # Resize video to 1920x1080
-                        ])
-                    command.extend(['-c:v', 'libaom-av1',
-                                    '-cpu-used', '8', # Speed preset (0-8, lower = better quality but slower)
-                                    '-row-mt', '1', # Enable row-based multithreading
-                                    '-tiles', '2x2', # Split encoding into 2x2 tiles for better parallelization
-                                    '-preset', '8', # Encoding speed preset (0-13, higher = faster)
-                                    '-svtav1-params', 'fast-decode=1', # Enable fast decoding mode
-                                    '-crf', str(quality if quality != 0 else 55), # Constant Rate Factor (0-63, lower = better quality)
-                                    '-b:v', '0' # Let CRF control bitrate
-                                    ])
-                    outputPath = outputPath + "_AV1.mp4"
-                    command.append(outputPath)                
-                print("Compressing video \t" + outputPath)
-                process = subprocess.Popen(command, stdout=subprocess.PIPE)
-                process.wait()
-                shutil.move(filePath, completedDir)
-    elif  model == "s80wifi":
-        filenames = list(filter(lambda f: f.endswith("A.MP4") or f.endswith("B.MP4"), filenamesInDir(outputDir)))
-        if len(filenames) == 0:
-            print("Didn't find any file to process for PAPAGO S80Wifi: " + outputDir)
-            return
-        skipNextFile = False
-        for i in range(len(filenames)):
-            if skipNextFile:
-                skipNextFile = False
+            # ffmpeg has been killed, the compressed file is incomplete
+            print("Incomplete compressed file, compress again \t" + job["output"])
+            os.remove(job["output"])
+        # The front camera is enough to know if the car is parked
+        ratio = frozenRatio(job["inputs"][0]) if staticPolicy != "encode" else None
+        if ratio is not None and ratio >= staticThreshold:
+            print("Static video (" + str(int(ratio * 100)) + "% frozen), " + staticPolicy + " \t" + job["output"])
+            if staticPolicy == "skip":
+                skippedDir = os.path.join(outputDir, 'skipped')
+                if not os.path.exists(skippedDir):
+                    os.makedirs(skippedDir)
+                for inputPath in job["inputs"]:
+                    manifestSet(outputDir, clipName(os.path.basename(inputPath)), "skipped")
+                    shutil.move(inputPath, skippedDir)
                 continue
-            # Look for related front(A)/back(B) videos
-            filenameCurr = filenames[i]
-            filenameNext = filenames[i] if (i == len(filenames) - 1) else filenames[i + 1]
-            dtCurr = getDatetime(filenameCurr, model)
-            dtNext = getDatetime(filenameNext, model)
-            interval = abs((dtCurr - dtNext).total_seconds())
-            # If both A & B are found (10 seconds tolerance), compress them to the same PIP video
-            if filenameCurr != filenameNext and interval <= 10:
-                mainFile = os.path.join(outputDir, (filenameCurr if filenameCurr.endswith("A.MP4") else filenameNext))
-                overlayFile = os.path.join(outputDir, (filenameNext if filenameNext.endswith("B.MP4") else filenameCurr))
-                outputPath = mainFile[:-5] + ".mp4"
-                if processor == 0: # CPU
-                    command = "ffmpeg -stats -loglevel error -i " + overlayFile + " -i " + mainFile + " -filter_complex \"[0]crop=iw:ih*3/4:0:ih/8[overlay];[overlay]hflip[overlay];[overlay]format=yuva420p,geq=lum='p(X,Y)':a='if(gt(abs(W/2-X),W/2-32)*gt(abs(H/2-Y),H/2-32),if(lte(hypot(32-(W/2-abs(W/2-X)),32-(H/2-abs(H/2-Y))),32),255,0),255)'[overlay];[overlay][1]scale2ref=iw/3:ow/mdar[overlay][main];[main][overlay]overlay=main_w/3:main_h/50\" -c:v libx265 -preset 5 -vtag hvc1 -x265-params log-level=error -crf " + str(quality if quality != 0 else getVideoQuality(mainFile)) + " -c:a aac -b:a 64k -ac 1 " + outputPath
-                elif processor == 1: # Nvidia GPU
-                    command = "ffmpeg -stats -loglevel error -i " + overlayFile + " -i " + mainFile + " -filter_complex \"[0]crop=iw:ih*3/4:0:ih/8[overlay];[overlay]hflip[overlay];[overlay]format=yuva420p,geq=lum='p(X,Y)':a='if(gt(abs(W/2-X),W/2-32)*gt(abs(H/2-Y),H/2-32),if(lte(hypot(32-(W/2-abs(W/2-X)),32-(H/2-abs(H/2-Y))),32),255,0),255)'[overlay];[overlay][1]scale2ref=iw/3:ow/mdar[overlay][main];[main][overlay]overlay=main_w/3:main_h/50\" -c:v hevc_nvenc -vtag hvc1 -rc constqp -qp " + str(quality if quality != 0 else 37) + " -c:a aac -b:a 64k -ac 1 " + outputPath 
-                elif processor == 2: # Apple GPU
-                    command = "ffmpeg -stats -loglevel error -i " + overlayFile + " -i " + mainFile + " -filter_complex \"[0]crop=iw:ih*3/4:0:ih/8[overlay];[overlay]hflip[overlay];[overlay]format=yuva420p,geq=lum='p(X,Y)':a='if(gt(abs(W/2-X),W/2-32)*gt(abs(H/2-Y),H/2-32),if(lte(hypot(32-(W/2-abs(W/2-X)),32-(H/2-abs(H/2-Y))),32),255,0),255)'[overlay];[overlay][1]scale2ref=iw/3:ow/mdar[overlay][main];[main][overlay]overlay=main_w/3:main_h/50\" -c:v hevc_videotoolbox -q:v " + str(quality if quality != 0 else 25) + " -g 240 -vtag hvc1 -c:a aac -b:a 64k -ac 1 " + outputPath 
-                print("Compressing PIP video \t" + outputPath)
-                process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-                process.wait()
-                shutil.move(mainFile, completedDir)
-                shutil.move(overlayFile, completedDir)
-                skipNextFile = True
-            # If only A or B is found, and file still exists, compress it only
-            elif filenameCurr.endswith("A.MP4") or filenameCurr.endswith("B.MP4"):
-                filePath = os.path.join(outputDir, filenameCurr)
-                outputPath = filePath[:-5] + ".mp4"
-                if processor == 0: # CPU
-                    command = "ffmpeg -stats -loglevel error -i " + filePath + " -c:v libx265 -preset 5 -vtag hvc1 -x265-params log-level=error -crf " + str(quality if quality != 0 else getVideoQuality(filePath)) + " -c:a aac -b:a 64k -ac 1 " + outputPath
-                elif processor == 1: # Nvidia GPU
-                    command = "ffmpeg -stats -loglevel error -i " + filePath + " -c:v hevc_nvenc -vtag hvc1 -rc constqp -qp " + str(quality if quality != 0 else 37) + " -c:a aac -b:a 64k -ac 1 " + outputPath 
-                elif processor == 2: # Apple GPU
-                    command = "ffmpeg -stats -loglevel error -i " + filePath + " -c:v hevc_videotoolbox -q:v " + str(quality if quality != 0 else 25) + " -g 240 -vtag hvc1 -c:a aac -b:a 64k -ac 1 " + outputPath 
-                print("Compressing video \t" + outputPath)
-                process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-                process.wait()
-                shutil.move(filePath, completedDir)
+            overlayFile = job["inputs"][1] if len(job["inputs"]) > 1 else None
+            job["command"] = compressCommand(job["inputs"][0], overlayFile, job["output"], encoder, quality, preset, threads, staticMask, staticPolicy=staticPolicy)
+            job["description"] += " (static, " + staticPolicy + ")"
+            # Cheap enough, not worth splitting into segments
+            pendingJobs.append(job)
+            continue
+        # Static videos aren't sampled, they would skew the rate control of the next videos
+        jobQuality = quality
+        if quality == 0 and (targetBitrate is not None or vmafFloor is not None):
+            overlayFile = job["inputs"][1] if len(job["inputs"]) > 1 else None
+            jobQuality = adaptiveQuality(job["inputs"][0], overlayFile, encoder, preset, threads, staticMask, model, job["output"])
+            job["command"] = compressCommand(job["inputs"][0], overlayFile, job["output"], encoder, jobQuality, preset, threads, staticMask)
+        # Planned & split by splitSource(), in the encoder pool, finding the keyframes reads the whole video
+        if segmentLength > 0 and job["duration"] is not None and job["duration"] >= segmentLength * 1.5:
+            job["segmentArgs"] = (encoder, jobQuality, preset, threads, staticMask, segmentLength)
+            job["description"] += " (segmented)"
+        pendingJobs.append(job)
+    return pendingJobs
+
+def compressVideos(outputDir, encoder, quality, model, jobs=1, preset=None, staticMask=False, segmentLength=0, staticPolicy="encode"):
+    # Build the full list of jobs first, then schedule them
+    sources = findSources(outputDir, model)
+    if sources is None:
+        return
+    # Segments are only known once the jobs are built, don't limit the workers to the number of videos
+    workers = jobCount(jobs, encoder, len(sources) if segmentLength <= 0 else sys.maxsize)
+    # Segments only pay off when they are encoded in parallel
+    if workers <= 1:
+        segmentLength = 0
+    jobList = buildJobs(sources, outputDir, encoder, quality, model, threadsPerJob(workers), preset, staticMask, segmentLength, staticPolicy)
+    runJobs(jobList, workers, os.path.join(outputDir, 'completed'))
+
+# Compressed files in the output directory, sorted for prefix lookups
+def compressedFilenames(outputDir, model):
+    if not os.path.exists(outputDir):
+        return []
+    if model == "d5":
+        return list(filter(lambda f: not clipName(f).endswith("a.MP4") and not clipName(f).endswith("b.MP4"), filenamesInDir(outputDir)))
+    elif  model == "s80wifi":
+        return list(filter(lambda f: not clipName(f).endswith("A.MP4") and not clipName(f).endswith("B.MP4"), filenamesInDir(outputDir)))
     elif model == "s36":
-        filenames = list(filter(lambda f: f.endswith(".MOV"), filenamesInDir(outputDir)))
-        if len(filenames) == 0:
-            print("Didn't find any file to process for PAPAGO S36: " + outputDir)
-            return
-        for i in range(len(filenames)):
-            filePath = os.path.join(outputDir, filenames[i])
-            if filePath.endswith(".MOV"):
-                outputPath = filePath[:-4] + ".mp4"
-                if processor == 0: # CPU
-                    command = "ffmpeg -stats -loglevel error -i " + filePath + " -c:v libx265 -preset 5 -vtag hvc1 -x265-params log-level=error -crf " + str(quality if quality != 0 else getVideoQuality(filePath)) + " -c:a aac -b:a 64k -ac 1 " + outputPath
-                elif processor == 1: # Nvidia GPU
-                    command = "ffmpeg -stats -loglevel error -i " + filePath + " -c:v hevc_nvenc -vtag hvc1 -rc constqp -qp " + str(quality if quality != 0 else 37) + " -c:a aac -b:a 64k -ac 1 " + outputPath 
-                elif processor == 2: # Apple GPU
-                    command = "ffmpeg -stats -loglevel error -i " + filePath + " -c:v hevc_videotoolbox -q:v " + str(quality if quality != 0 else 25) + " -g 240 -vtag hvc1 -c:a aac -b:a 64k -ac 1 " + outputPath 
-                print("Compressing video \t" + outputPath)
-                process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-                process.wait()
-                shutil.move(filePath, completedDir)
-
-def catAndCopyFiles(filenames, inputDir, outputDir, model):
+        return list(filter(lambda f: not clipName(f).endswith(".MOV"), filenamesInDir(outputDir)))
+    return []
+
+def hasPrefix(sortedNames, prefix):
+    i = bisect.bisect_left(sortedNames, prefix)
+    return i < len(sortedNames) and sortedNames[i].startswith(prefix)
+
+def catAndCopyFiles(filenames, inputDir, outputDir, model, stream=False, compressedNames=None):
     # Create directory if not exists
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
     # Create a temp file in the output directory
     print("Cat & copy files:\n" + ("\n".join(filenames)))
     filename = filenames[0]
-    # Temp file path
-    output = os.path.join(outputDir, filename)
+    # Temp file path, or concat list path in stream mode
+    output = os.path.join(outputDir, filename) + (concatListExt if stream else "")
+    inputPaths = list(map(lambda file: os.path.join(inputDir, file), filenames))
+    fingerprint = inputFingerprint(inputPaths)
     # Check if we can skip
-    if os.path.exists(output):
-        print("Temp file already exists, skip cat & copy for \"" + output + "\"")
-        return False
-    if model == "d5":
-        allCompressedFileNames = list(filter(lambda f: not f.endswith("a.MP4") and not f.endswith("b.MP4"), filenamesInDir(outputDir)))
-        if len(list(filter(lambda f: f.startswith(filename[:-10]), allCompressedFileNames))) > 0:
+    entry = manifestGet(outputDir, filename)
+    if entry is not None and entry["fingerprint"] == fingerprint:
+        if entry["state"] == "done":
             print("Compressed file already exists, skip cat & copy for \"" + output + "\"")
             return False
-    elif  model == "s80wifi":
-        allCompressedFileNames = list(filter(lambda f: not f.endswith("A.MP4") and not f.endswith("B.MP4"), filenamesInDir(outputDir)))
-        if len(list(filter(lambda f: f.startswith(filename[:-10]), allCompressedFileNames))) > 0:
-            print("Compressed file already exists, skip cat & copy for \"" + output + "\"")
+        if entry["state"] == "skipped":
+            print("Static video has been skipped, skip cat & copy for \"" + output + "\"")
             return False
-    elif model == "s36":
-        allCompressedFileNames = list(filter(lambda f: not f.endswith(".MOV"), filenamesInDir(outputDir)))
-        if len(list(filter(lambda f: f.startswith(filename[:-4]), allCompressedFileNames))) > 0:
+        if entry["state"] != "discovered" and os.path.exists(output):
+            print("Temp file already exists, skip cat & copy for \"" + output + "\"")
+            return False
+        # The previous cat & copy has been interrupted or has failed, do it again
+        if os.path.exists(output):
+            print("Incomplete temp file, cat & copy again for \"" + output + "\"")
+            os.remove(output)
+    else:
+        # Not in the manifest, e.g. processed by an older version
+        if os.path.exists(output):
+            print("Temp file already exists, skip cat & copy for \"" + output + "\"")
+            manifestSet(outputDir, filename, "concatenated", inputs=filenames, fingerprint=fingerprint)
+            return False
+        if compressedNames is None:
+            compressedNames = compressedFilenames(outputDir, model)
+        if hasPrefix(compressedNames, filename[:-4] if model == "s36" else filename[:-10]):
             print("Compressed file already exists, skip cat & copy for \"" + output + "\"")
+            manifestSet(outputDir, filename, "done", inputs=filenames, fingerprint=fingerprint)
             return False
-    # Skip if temp file exists
-    if os.path.exists(output):
-        print("Temp file already exists, skip cat & copy for \"" + output + "\"")
+    manifestSet(outputDir, filename, "discovered", inputs=filenames, fingerprint=fingerprint)
+    # In stream mode, only write the concat list, the clips will be read in place by the encoder
+    if stream:
+        print("-> \"" + output + "\"")
+        writeConcatList(output, list(map(os.path.abspath, inputPaths)))
+        manifestSet(outputDir, filename, "concatenated")
         return True
     # If there is only 1 file, return the original path directly
     if len(filenames) == 1:
         inputPath= os.path.join(inputDir, filename)
-        print("-> \"" + output + "\"")
-        shutil.copy(inputPath, output)
+        print("-> \"" + output + "\" (" + stageFile(inputPath, output) + ")")
+        manifestSet(outputDir, filename, "concatenated")
         return True
     # If there are multiple files, join all of them
     print("-> \"" + output + "\"")
-    inputPaths = list(map(lambda file: os.path.join(inputDir, file), filenames))
     # print("Join Files:\n" + "\n".join(inputPaths))
-    # generate "list.txt" file
-    with open("list.txt", "w") as f:
-        f.write("\n".join(map(lambda f: "file '" + f + "'", inputPaths)))
-    command = "ffmpeg -stats -loglevel error -err_detect ignore_err -f concat -safe 0 -i list.txt -c copy " + output
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-    process.wait()
+    # generate the concat list in a temp file
+    listFile, listPath = tempfile.mkstemp(suffix=concatListExt)
+    os.close(listFile)
+    writeConcatList(listPath, list(map(os.path.abspath, inputPaths)))
+    command = ffmpegArgs + inputArgs(listPath) + ['-c', 'copy', output]
+    addProgress(output, getVideoDuration(listPath))
+    returncode = runFfmpeg(command, output)
+    removeProgress(output)
+    os.remove(listPath)
+    if returncode != 0:
+        print("Failed to cat files for \"" + output + "\"")
+        manifestSet(outputDir, filename, "failed")
+        if os.path.exists(output):
+            os.remove(output)
+        return False
+    manifestSet(outputDir, filename, "concatenated")
     return True
 
-# Try to detect relationships and link files
-# If files are related (based on the clip length), they will be linked together
-# Else, simply copy to the output directory
-def catFiles(filenames, inputDir, outputDir, clipLength, model):
-    files = []
-    for i in range(len(filenames)):
-        fileCurr = filenames[i]
-        # If it's the 1st file, simply add to list
-        if i == 0:
-            files.append(fileCurr) 
+# Same volume, the staged file can share the data of the original clip
+def sameFilesystem(pathA, pathB):
+    return os.stat(pathA).st_dev == os.stat(pathB).st_dev
+
+FICLONE = 0x40049409 # Linux ioctl cloning the extents of a file
+
+# Whether a clip can be hard linked into the output directory, by trying it
+# The same volume isn't enough, FAT/exFAT (the SD cards) don't support hard links
+def canLink(inputPath, outputDir):
+    if not sameFilesystem(inputPath, outputDir):
+        return False
+    linkPath = os.path.join(outputDir, "." + os.path.basename(inputPath) + ".link")
+    try:
+        os.link(inputPath, linkPath)
+    except OSError:
+        return False
+    os.remove(linkPath)
+    return True
+
+# Stage a single clip without copying its data if possible, returns how it has been staged
+# A hard link or a reflink needs the same volume, and a filesystem supporting them (not FAT/exFAT)
+def stageFile(inputPath, outputPath):
+    if sameFilesystem(inputPath, os.path.dirname(os.path.abspath(outputPath))):
+        try:
+            os.link(inputPath, outputPath)
+            return "hard link"
+        except OSError:
+            pass
+        # Copy-on-write clone (Btrfs, XFS)
+        if fcntl is not None and sys.platform.startswith("linux"):
+            try:
+                with open(inputPath, "rb") as src, open(outputPath, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                os.remove(outputPath)
+    # copyfile uses sendfile (Linux) or fcopyfile (macOS), the data doesn't go through Python
+    shutil.copyfile(inputPath, outputPath)
+    return "copy"
+
+# Bytes written to the output volume to stage the groups which haven't been staged yet
+# Single clips are free when they can be hard linked, joined clips are always written
+def stagingSize(groups, inputDir, outputDir, model, stream=False):
+    if stream:
+        return 0
+    linkable = None # Tried with the first single clip to stage
+    size = 0
+    for group in groups:
+        if os.path.exists(os.path.join(outputDir, group[0].name)):
+            continue
+        entry = manifestGet(outputDir, group[0].name)
+        if entry is not None and entry["state"] in ("done", "skipped"):
+            continue
+        if len(group) == 1:
+            if linkable is None:
+                linkable = canLink(os.path.join(inputDir, group[0].name), outputDir)
+            if linkable:
+                continue
+        size += sum(clip.size if clip.size is not None else os.path.getsize(os.path.join(inputDir, clip.name)) for clip in group)
+    return size
+
+def formatSize(size):
+    return str(round(size / 1048576, 1)) + " MB"
+
+# Clips can only be joined with "-c copy" if they have the same streams and resolution
+# If one of them can't be probed (e.g. the last clip is truncated), let ffmpeg try anyway
+def sameLayout(pathA, pathB):
+    probeA, probeB = probeVideo(pathA), probeVideo(pathB)
+    if probeA is None or probeB is None:
+        return True
+    return (probeA["streams"], probeA["width"], probeA["height"]) == (probeB["streams"], probeB["width"], probeB["height"])
+
+# Splits the time-sorted clips of a camera into groups of related clips
+# If clips are related (based on the clip length), they will be linked together
+def groupClips(clips, inputDir, clipLength):
+    groups = []
+    for clip in clips:
+        # If it's linked to the last clip, and can be joined without re-encoding, add to its group
+        if len(groups) > 0 and linkedClip(groups[-1][-1], clip, inputDir, clipLength):
+            groups[-1].append(clip)
+        # Else, start a new group
         else:
-            dtPrev = getDatetime(filenames[i-1], model)
-            dtCurr = getDatetime(fileCurr, model)
-            interval = (dtCurr - dtPrev).total_seconds()
-            # If it's linked to the last file, add to list
-            if abs(interval) <= (clipLength + 30): # 30 seconds tolerance
-                files.append(fileCurr)
-            # Else, join the current files list
-            else:
-                catAndCopyFiles(files, inputDir, outputDir, model)
-                # And start a new list
-                files = [fileCurr]
-        # If it's the last file, join the files in the list
-        if i == len(filenames) - 1:
-            catAndCopyFiles(files, inputDir, outputDir, model)
-
-def process(inputDir, outputDir, clipLength, processor, codec, quality, model):
-    if os.path.exists(inputDir):
-        filenames = filenamesInDir(inputDir)
-        if model == "d5":
-            filenamesA, filenamesB = [], []
-            for filename in filenames:
-                if filename.endswith("a.MP4"):
-                    filenamesA.append(filename)
-                elif filename.endswith("b.MP4"):
-                    filenamesB.append(filename)
-            catFiles(filenamesA, inputDir, outputDir, clipLength, model)
-            catFiles(filenamesB, inputDir, outputDir, clipLength, model)
-            compressVideos(outputDir, processor, codec, quality, model)
-        elif  model == "s80wifi":
-            filenamesA, filenamesB = [], []
-            for filename in filenames:
-                if filename.endswith("A.MP4"):
-                    filenamesA.append(filename)
-                elif filename.endswith("B.MP4"):
-                    filenamesB.append(filename)
-            catFiles(filenamesA, inputDir, outputDir, clipLength, model)
-            catFiles(filenamesB, inputDir, outputDir, clipLength, model)
-            compressVideos(outputDir, processor, codec, quality, model)
-        elif model == "s36":
-            catFiles(filenames, inputDir, outputDir, clipLength, model)
-            compressVideos(outputDir, processor, codec, quality, model)
+            groups.append([clip])
+    return groups
+
+# A clip follows the last clip of a group if it starts within the clip length (+ tolerance), and can be joined without re-encoding
+clipTolerance = 30 # Seconds
+
+def linkedClip(last, clip, inputDir, clipLength):
+    return closeClips(last, clip, clipLength) and sameLayout(os.path.join(inputDir, last.name), os.path.join(inputDir, clip.name))
+
+# Only the timestamps, for the clips which can't be probed yet
+def closeClips(last, clip, clipLength):
+    return abs((clip.timestamp - last.timestamp).total_seconds()) <= (clipLength + clipTolerance)
+
+# Try to detect relationships and link files
+# Linked files are joined together, else simply copy to the output directory
+def catFiles(groups, inputDir, outputDir, model, stream=False):
+    # List the compressed files only once, for the groups which aren't in the manifest
+    compressedNames = compressedFilenames(outputDir, model)
+    for group in groups:
+        start = time.perf_counter()
+        if catAndCopyFiles([clip.name for clip in group], inputDir, outputDir, model, stream, compressedNames):
+            recordMetric("concat", os.path.join(outputDir, group[0].name), time.perf_counter() - start, clips=len(group))
+
+# Bytes reserved on each output volume (by device) for the cards being staged, so that the cards staged at the same time
+# in batch mode don't count the same free space
+stagingReserved = {}
+stagingLock = threading.Lock()
+
+# Stage the clips of all the cameras, if the output volume has enough free space for all of them
+# Checked up front, so a card is never left half staged when the disk fills up, returns False if there isn't enough
+def stageClips(clips, inputDir, outputDir, clipLength, model, stream=False):
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    groups = {camera: groupClips(clips[camera], inputDir, clipLength) for camera in clips}
+    sizes = {camera: stagingSize(groups[camera], inputDir, outputDir, model, stream) for camera in groups}
+    needed = sum(sizes.values())
+    device = os.stat(outputDir).st_dev
+    with stagingLock:
+        free = shutil.disk_usage(outputDir).free - stagingReserved.get(device, 0)
+        if needed > free:
+            print("Not enough free space to stage the clips of " + str(inputDir) + ": " + formatSize(needed) + " needed, " + formatSize(max(0, free)) + " free")
+            return False
+        stagingReserved[device] = stagingReserved.get(device, 0) + needed
+    # Once the clips of a camera are staged, they're counted by the free space of the volume
+    for camera in sorted(groups):
+        try:
+            catFiles(groups[camera], inputDir, outputDir, model, stream)
+        finally:
+            with stagingLock:
+                stagingReserved[device] -= sizes[camera]
+    return True
+
+def process(inputDir, outputDir, clipLength, encoder, quality, model, jobs=1, stream=False, probeCacheFile=None, preset=None, staticMask=False, segmentLength=0, staticPolicy="encode"):
+    loadProbeCache(probeCacheFile if probeCacheFile else os.path.join(outputDir, ".probe_cache.json"))
+    try:
+        processDir(inputDir, outputDir, clipLength, encoder, quality, model, jobs, stream, preset, staticMask, segmentLength, staticPolicy)
+    finally:
+        saveProbeCache()
+        closeManifest(outputDir)
+
+def processDir(inputDir, outputDir, clipLength, encoder, quality, model, jobs=1, stream=False, preset=None, staticMask=False, segmentLength=0, staticPolicy="encode"):
+    if inputDir is not None and os.path.exists(inputDir):
+        # Index the clips once, then join the related clips of each camera
+        stageClips(indexClips(filenamesInDir(inputDir), model, inputDir), inputDir, outputDir, clipLength, model, stream)
+    compressVideos(outputDir, encoder, quality, model, jobs, preset, staticMask, segmentLength, staticPolicy)
+
+# Dash cam model of the clips in a directory, the one matching the most files, None if no file matches
+def detectModel(dir):
+    if dir is None or not os.path.exists(dir):
+        return None
+    filenames = filenamesInDir(dir)
+    counts = {model: sum(len(clips) for clips in indexClips(filenames, model).values()) for model in cameraModels}
+    model = max(counts, key=counts.get)
+    return model if counts[model] > 0 else None
+
+# Cat & copy the clips of a card, then queue its compression jobs in the shared encoder pool
+# Returns the (job, future) pairs of the card
+def processCard(card, clipLength, encoder, quality, stream, preset, staticMask, segmentLength, staticPolicy, encoderPool, finisherPool, threads):
+    inputDir, outputDir, model = card
+    if model is None:
+        model = detectModel(inputDir) or detectModel(outputDir)
+        if model is None:
+            print("Couldn't detect the dash cam model of " + str(inputDir))
+            return []
+        print("Detected " + cameraModels[model]["description"] + ": " + str(inputDir))
+    if inputDir is not None and os.path.exists(inputDir):
+        stageClips(indexClips(filenamesInDir(inputDir), model, inputDir), inputDir, outputDir, clipLength, model, stream)
+    sources = findSources(outputDir, model)
+    if sources is None:
+        return []
+    # Analyzing & sampling the videos runs ffmpeg too, it waits for a worker, like the encodes
+    jobList = encoderPool.submit(buildJobs, sources, outputDir, encoder, quality, model, threads, preset, staticMask, segmentLength, staticPolicy).result()
+    futures = []
+    for job in jobList:
+        addJobProgress(job)
+        print(job["description"] + " \t" + job["output"])
+        futures.append((job, submitJob(job, os.path.join(outputDir, 'completed'), encoderPool, finisherPool)))
+    return futures
+
+# Processes several cards at once, cards is a list of (inputDir, outputDir, model), model is detected if it's None
+# Every card is copied in its own thread, and all the ffmpeg work (the compression jobs, and the static analysis
+# and rate control sampling building them) shares one pool of workers, so that copying a card overlaps with
+# compressing the videos of the others, without running more than --jobs encoders
+def processBatch(cards, clipLength, encoder, quality, jobs=1, stream=False, probeCacheFile=None, preset=None, staticMask=False, segmentLength=0, staticPolicy="encode"):
+    loadProbeCache(probeCacheFile if probeCacheFile else os.path.join(cards[0][1], ".probe_cache.json"))
+    workers = jobCount(jobs, encoder, sys.maxsize)
+    if workers <= 1:
+        segmentLength = 0
+    threads = threadsPerJob(workers)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as encoderPool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as finisherPool:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(cards)) as cardPool:
+                cardFutures = [cardPool.submit(processCard, card, clipLength, encoder, quality, stream, preset, staticMask, segmentLength, staticPolicy, encoderPool, finisherPool, threads) for card in cards]
+                # Summary, in the same order as the cards and jobs
+                for card, cardFuture in zip(cards, cardFutures):
+                    for job, future in cardFuture.result():
+                        returncode = future.result()
+                        print(("Done" if returncode == 0 else "Failed (" + str(returncode) + ")") + " \t" + job["output"])
+    finally:
+        saveProbeCache()
+        for card in cards:
+            closeManifest(card[1])
+
+# Cards of a batch config file, a JSON list of {"input": ..., "output": ..., "model": ...}, model is optional
+def loadBatchConfig(path):
+    with open(path) as f:
+        config = json.load(f)
+    cards = []
+    for card in config:
+        if card.get("model") is not None and card["model"] not in cameraModels:
+            print("Unknown model parameter for card " + card["input"])
+            continue
+        cards.append((card["input"], card["output"], card.get("model")))
+    return cards
+
+# Watch mode: the input directory is watched for new clips, with inotify on Linux, else by polling it every watchInterval seconds
+# A clip is ready once it has been closed (inotify), or its size hasn't changed for watchSettle seconds, it may still be uploading
+# Ready clips are grouped as they come, a group is finalized once a later clip starts another group, or once no clip has
+# been added to it for the clip length (+ tolerance), but never while a clip being written could still join it,
+# then it's staged, and compressed by the encoder pool as soon as its PIP pair can't change anymore
+watchInterval = 5
+watchSettle = 10
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+# inotify file descriptor watching a directory, None if inotify isn't available
+def inotifyWatch(dir):
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(dir), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+# Waits for changes in the watched directory, or for the timeout
+# Returns the names of the files which have been closed after writing, or moved in
+def waitForChanges(fd, timeout):
+    if fd is None:
+        time.sleep(timeout)
+        return set()
+    closed = set()
+    if not select.select([fd], [], [], timeout)[0]:
+        return closed
+    try:
+        while True:
+            events = os.read(fd, 65536)
+            offset = 0
+            # struct inotify_event: wd, mask, cookie, len, then the name padded with NULs
+            while offset < len(events):
+                _, mask, _, length = struct.unpack_from("iIII", events, offset)
+                name = events[offset + 16:offset + 16 + length].rstrip(b"\0")
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    closed.add(os.fsdecode(name))
+                offset += 16 + length
+    except BlockingIOError: # No more events
+        pass
+    return closed
+
+# Reported as soon as a job is over, there is no final summary in watch mode
+def reportJob(job, future):
+    # The segments of a job may have been cancelled while it was waiting for them
+    if future.cancelled() or isinstance(future.exception(), concurrent.futures.CancelledError):
+        print("Cancelled \t" + job["output"])
+    elif future.exception() is not None:
+        print("Failed (" + str(future.exception()) + ") \t" + job["output"])
+    else:
+        print(("Done" if future.result() == 0 else "Failed (" + str(future.result()) + ")") + " \t" + job["output"])
+
+# Called once the jobs have been built in the encoder pool, so that the scan loop never waits for the probes
+def queueJobs(jobList, outputDir, encoderPool, finisherPool):
+    if jobList.cancelled():
+        return
+    if jobList.exception() is not None:
+        print("Failed to prepare the jobs (" + str(jobList.exception()) + ")")
+        return
+    for job in jobList.result():
+        addJobProgress(job)
+        try:
+            future = submitJob(job, os.path.join(outputDir, 'completed'), encoderPool, finisherPool)
+        except RuntimeError: # Stopped watching meanwhile, compressed by the next run
+            return
+        print(job["description"] + " \t" + job["output"])
+        future.add_done_callback(lambda future, job=job: reportJob(job, future))
+    saveProbeCache()
+
+def watch(inputDir, outputDir, clipLength, encoder, quality, model, jobs=1, stream=False, probeCacheFile=None, preset=None, staticMask=False, segmentLength=0, staticPolicy="encode"):
+    loadProbeCache(probeCacheFile if probeCacheFile else os.path.join(outputDir, ".probe_cache.json"))
+    workers = jobCount(jobs, encoder, sys.maxsize)
+    if workers <= 1:
+        segmentLength = 0
+    threads = threadsPerJob(workers)
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    notifyFd = inotifyWatch(inputDir)
+    print("Watching " + inputDir + (" (inotify)" if notifyFd is not None else " (polling every " + str(watchInterval) + "s)"))
+    changes = {} # Files which aren't ready, filename -> (size, mtime, time of the last change)
+    seen = set() # Ready clips
+    readyClips = {} # camera -> ready clips which haven't been staged yet
+    readyTimes = {} # filename -> time it became ready
+    submitted = set() # Main files of the jobs
+    waiting = False # Staged videos waiting for their PIP pair
+    closed = set()
+    encoderPool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    finisherPool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            now = time.time()
+            ready, pending = [], []
+            for filename in filenamesInDir(inputDir):
+                if filename in seen:
+                    continue
+                clip = parseClip(filename, model)
+                if clip is None:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(inputDir, filename))
+                except OSError: # Removed meanwhile
+                    continue
+                state = (stat.st_size, stat.st_mtime_ns)
+                if filename not in closed and (filename not in changes or changes[filename][0] != state):
+                    changes[filename] = (state, now)
+                    pending.append(clip)
+                elif stat.st_size == 0 or (filename not in closed and now - changes[filename][1] < watchSettle):
+                    pending.append(clip)
+                else:
+                    ready.append(parseClip(filename, model, inputDir))
+                    seen.add(filename)
+                    changes.pop(filename, None)
+            closed -= seen
+            for clip in ready:
+                readyClips.setdefault(clip.camera, []).append(clip)
+                readyTimes[clip.name] = now
+            # Group the ready clips again, a clip may be ready before the previous one, if it has been written faster
+            finalized = []
+            for camera in list(readyClips):
+                groups = groupClips(sorted(readyClips[camera], key=lambda clip: (clip.timestamp, clip.name)), inputDir, clipLength)
+                readyClips[camera] = []
+                for i, group in enumerate(groups):
+                    joinable = any(closeClips(group[0], clip, clipLength) or closeClips(group[-1], clip, clipLength) for clip in pending if clip.camera == camera)
+                    quiet = now - max(readyTimes[clip.name] for clip in group) > clipLength + clipTolerance
+                    if not joinable and (i + 1 < len(groups) or quiet):
+                        finalized.append(group)
+                    else:
+                        readyClips[camera].extend(group)
+                if len(readyClips[camera]) == 0:
+                    del readyClips[camera]
+            for group in finalized:
+                for clip in group:
+                    del readyTimes[clip.name]
+            staged = False
+            for group in finalized:
+                # Without enough free space, the clips are found again by a later scan, and grouped again
+                if stageClips({group[0].camera: group}, inputDir, outputDir, clipLength, model, stream):
+                    staged = True
+                else:
+                    seen.difference_update(clip.name for clip in group)
+            if staged or waiting:
+                # The videos starting before the open groups & the clips being written can be paired (10 seconds tolerance)
+                openTimes = [clip.timestamp for clips in readyClips.values() for clip in clips] + [clip.timestamp for clip in pending]
+                horizon = min(openTimes) - datetime.timedelta(seconds=10) if openTimes else None
+                sources = [source for source in findSources(outputDir, model) or [] if source[0] not in submitted]
+                ripe = [source for source in sources if horizon is None or parseClip(os.path.basename(clipName(source[0])), model).timestamp < horizon]
+                waiting = len(ripe) < len(sources)
+                if len(ripe) > 0:
+                    # Building the jobs probes the videos (freeze detection, rate control samples, keyframes), like the encodes
+                    jobList = encoderPool.submit(buildJobs, ripe, outputDir, encoder, quality, model, threads, preset, staticMask, segmentLength, staticPolicy)
+                    jobList.add_done_callback(lambda jobList: queueJobs(jobList, outputDir, encoderPool, finisherPool))
+                    submitted.update(source[0] for source in ripe)
+            closed |= waitForChanges(notifyFd, watchInterval)
+    except KeyboardInterrupt:
+        # The running encodes are interrupted too, the queued ones are cancelled, and compressed by the next run
+        print("Stopped watching " + inputDir)
+    finally:
+        encoderPool.shutdown(cancel_futures=True)
+        finisherPool.shutdown(cancel_futures=True)
+        if notifyFd is not None:
+            os.close(notifyFd)
+        saveProbeCache()
+        closeManifest(outputDir)
+
+# Synthetic dash cam clips, named like the clips of the model
+# Clips come in pairs of related clips (one drive every hour), so that there are several groups to schedule
+def makeBenchmarkClips(clipDir, model, count, duration, resolution):
+    start = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    for i in range(count):
+        dt = start + datetime.timedelta(hours=i // 2, seconds=(i % 2) * duration)
+        for camera in cameraModels[model]["cameras"]:
+            if model == "d5":
+                filename = dt.strftime("%Y_%m%d_%H%M%S") + "_00_" + camera.lower() + ".MP4"
+            elif model == "s80wifi":
+                filename = dt.strftime("%Y_%m%d_%H%M%S") + "_" + str(i % 1000).zfill(3) + camera + ".MP4"
+            elif model == "s36":
+                filename = dt.strftime("%Y-%m-%d-%H-%M-%S") + ".MOV"
+            command = ['ffmpeg', '-loglevel', 'error', '-y',
+                       '-f', 'lavfi', '-i', 'testsrc2=size=' + resolution + ':rate=30:duration=' + str(duration),
+                       '-f', 'lavfi', '-i', 'sine=frequency=' + str(440 + i) + ':duration=' + str(duration),
+                       '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                       '-c:a', 'aac', '-shortest',
+                       os.path.join(clipDir, filename)]
+            subprocess.Popen(command, stdout=subprocess.DEVNULL).wait()
+
+# CPU time of all the children so far, the difference is the CPU time of a benchmark run
+def childrenCpuTime():
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def dirSize(dir, extension):
+    return sum(os.path.getsize(os.path.join(dir, f)) for f in filenamesInDir(dir) if f.endswith(extension))
+
+# Runs the whole pipeline over synthetic clips for each combination of settings
+# The report is written as JSON, or as CSV if the report path ends with ".csv"
+def benchmark(reportPath, model, encoderNames, presets, qualities, jobsList, stream, count, duration, resolution):
+    results = []
+    with tempfile.TemporaryDirectory() as benchDir:
+        clipDir = os.path.join(benchDir, "clips")
+        os.makedirs(clipDir)
+        print("Generating " + str(count) + " synthetic " + cameraModels[model]["description"] + " clips (" + resolution + ", " + str(duration) + "s)")
+        makeBenchmarkClips(clipDir, model, count, duration, resolution)
+        inputSize = sum(os.path.getsize(os.path.join(clipDir, f)) for f in filenamesInDir(clipDir))
+        frames = count * duration * 30
+        for encoder in encoderNames:
+            for preset in presets:
+                for quality in qualities:
+                    for jobs in jobsList:
+                        outputDir = os.path.join(benchDir, "output")
+                        shutil.rmtree(outputDir, ignore_errors=True)
+                        print("Benchmark: encoder=" + encoder + " preset=" + str(preset) + " quality=" + str(quality) + " jobs=" + str(jobs))
+                        cpuBefore = childrenCpuTime()
+                        resetPeakRss()
+                        start = time.perf_counter()
+                        process(clipDir, outputDir, duration, encoder, quality, model, jobs, stream, None, preset)
+                        wallTime = time.perf_counter() - start
+                        cpuAfter = childrenCpuTime()
+                        outputSize = dirSize(outputDir, ".mp4")
+                        results.append({"model": model,
+                                        "encoder": encoder,
+                                        "preset": preset if preset is not None or encoders[encoder]["preset"] is None else encoders[encoder]["preset"][1],
+                                        "quality": quality,
+                                        "jobs": jobs,
+                                        "stream": stream,
+                                        "wallTime": round(wallTime, 3),
+                                        "cpuTime": round(cpuAfter - cpuBefore, 3),
+                                        "peakRssKB": peakRss, # Largest ffmpeg process of this run
+                                        "fps": round(frames / wallTime, 2),
+                                        "inputSize": inputSize,
+                                        "outputSize": outputSize,
+                                        "compressionRatio": round(inputSize / outputSize, 2) if outputSize > 0 else None})
+    if reportPath.endswith(".csv"):
+        with open(reportPath, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()) if results else [])
+            writer.writeheader()
+            writer.writerows(results)
     else:
-        if model == "d5":
-            compressVideos(outputDir, processor, codec, quality, model)
-        elif  model == "s80wifi":
-            compressVideos(outputDir, processor, codec, quality, model)
-        elif model == "s36":
-            compressVideos(outputDir, processor, codec, quality, model)
+        with open(reportPath, "w") as f:
+            json.dump(results, f, indent=2)
+    print("Benchmark report: " + reportPath)
+    return results
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -366,10 +1689,79 @@ if __name__ == '__main__':
     parser.add_argument("-l", "--length", dest = "length", help = "Clip Length in second", type = int, default = 300)
     parser.add_argument("-p", "--processor", dest = "processor", help = "Process Type, 0 = CPU, 1 = Nvidia GPU, 2 = Apple GPU", type = int, default = 0)
     parser.add_argument("-c", "--codec", dest = "codec", help = "Codec, 0 = HEVC, 1 = AV1", type = int, default = 0)
+    parser.add_argument("-e", "--encoder", dest = "encoder", help = "Encoder (" + ", ".join(encoders) + "), overrides the processor and codec parameters", type = str, default = None)
+    parser.add_argument("--preset", dest = "preset", help = "Encoder speed preset, default depends on the encoder", type = str, default = None)
     parser.add_argument("-q", "--quality", dest = "quality", help = "Quality (CRF/CQ)", type = int, default = 0)
-    parser.add_argument("-m", "--model", dest = "model", help = "Dash cam model (d5, s80wifi, s36)", type = str, default="d5")
+    parser.add_argument("-m", "--model", dest = "model", help = "Dash cam model (d5, s80wifi, s36), default is d5, or detected for each card in batch mode", type = str, default = None)
+    parser.add_argument("--card", dest = "cards", help = "Batch mode: input and output directories of a card, can be repeated", nargs = 2, metavar = ("INPUT", "OUTPUT"), action = "append", default = [])
+    parser.add_argument("--batch", dest = "batch", help = "Batch mode: JSON list of cards, [{\"input\": ..., \"output\": ..., \"model\": ...}]", type = str, default = None)
+    parser.add_argument("-s", "--stream", dest = "stream", help = "Feed the related clips to the encoder directly, without writing the concatenated video", action = "store_true")
+    parser.add_argument("--static-mask", dest = "staticMask", help = "Use a pre-generated mask for the rounded corners of PIP videos, faster than computing it for every frame", action = "store_true")
+    parser.add_argument("--segment-length", dest = "segmentLength", help = "Split the videos longer than this (in second) into segments of about this length, and compress the segments in parallel (needs --jobs > 1), 0 = never split", type = int, default = 0)
+    parser.add_argument("--static-policy", dest = "staticPolicy", help = "What to do with static (parked) videos: encode (like the others), fast (faster preset, " + str(staticFps) + " fps), timelapse (keyframes only) or skip", type = str, default = "encode")
+    parser.add_argument("--static-threshold", dest = "staticThreshold", help = "Share of frozen time from which a video is static", type = float, default = 0.9)
+    parser.add_argument("--target-size", dest = "targetSize", help = "Rate control mode: size budget per hour of video in MB, the quality is chosen by encoding a few samples, unless it's specified", type = float, default = None)
+    parser.add_argument("--vmaf-floor", dest = "vmafFloor", help = "Rate control mode: lowest VMAF, the cheapest quality above it is chosen (within --target-size), needs ffmpeg with libvmaf", type = float, default = None)
+    parser.add_argument("--retention", dest = "retention", help = "What to do with the staged sources once compressed: keep (in the completed directory), delete, or archive (to --archive-dir)", type = str, default = "keep")
+    parser.add_argument("--archive-dir", dest = "archiveDir", help = "Directory of the archived sources, with --retention archive", type = str, default = None)
+    parser.add_argument("--watch", dest = "watch", help = "Watch the input directory, and compress the new clips as they come, until interrupted", action = "store_true")
+    parser.add_argument("--watch-interval", dest = "watchInterval", help = "Watch mode: seconds between scans of the input directory", type = float, default = 5)
+    parser.add_argument("--watch-settle", dest = "watchSettle", help = "Watch mode: seconds without change before a clip is ready, unless inotify reports it closed", type = float, default = 10)
+    parser.add_argument("-j", "--jobs", dest = "jobs", help = "Number of videos to compress in parallel, or \"auto\"", type = str, default = "1")
+    parser.add_argument("--probe-cache", dest = "probeCache", help = "Probe cache file, default is .probe_cache.json in the output directory", type = str, default = None)
+    parser.add_argument("--metrics", dest = "metrics", help = "Append the time spent in each stage to this file (JSON lines)", type = str, default = None)
+    parser.add_argument("--progress-interval", dest = "progressInterval", help = "Seconds between progress reports", type = float, default = 10)
+    parser.add_argument("--benchmark", dest = "benchmark", help = "Benchmark over synthetic clips instead of processing the input directory, and write the report (JSON, or CSV if it ends with .csv) to this path", type = str, default = None)
+    parser.add_argument("--bench-encoders", dest = "benchEncoders", help = "Benchmark: comma-separated encoders, default is the selected encoder", type = str, default = None)
+    parser.add_argument("--bench-presets", dest = "benchPresets", help = "Benchmark: comma-separated presets, default is the encoder's preset", type = str, default = None)
+    parser.add_argument("--bench-qualities", dest = "benchQualities", help = "Benchmark: comma-separated qualities, 0 = default", type = str, default = "0")
+    parser.add_argument("--bench-jobs", dest = "benchJobs", help = "Benchmark: comma-separated job counts", type = str, default = "1,auto")
+    parser.add_argument("--bench-clips", dest = "benchClips", help = "Benchmark: number of clips per camera", type = int, default = 4)
+    parser.add_argument("--bench-duration", dest = "benchDuration", help = "Benchmark: clip length in second", type = int, default = 10)
+    parser.add_argument("--bench-resolution", dest = "benchResolution", help = "Benchmark: clip resolution", type = str, default = "1920x1080")
     args = parser.parse_args()
     if args.processor != 0 and args.processor != 1 and args.processor != 2:
         print("Unknown processor parameter")
+    elif args.codec != 0 and args.codec != 1:
+        print("Unknown codec parameter")
+    elif args.encoder is not None and args.encoder not in encoders:
+        print("Unknown encoder parameter")
+    elif args.model is not None and args.model not in cameraModels:
+        print("Unknown model parameter")
+    elif args.jobs != "auto" and (not args.jobs.isdigit() or int(args.jobs) < 1):
+        print("Unknown jobs parameter")
+    elif args.staticPolicy not in staticPolicies:
+        print("Unknown static policy parameter")
+    elif args.watch and (args.input is None or args.output is None):
+        print("Missing input or output directory parameter")
+    elif args.retention not in retentionPolicies:
+        print("Unknown retention parameter")
+    elif args.retention == "archive" and args.archiveDir is None:
+        print("Missing archive directory parameter")
     else:
-        process(args.input, args.output, args.length, args.processor, args.codec, args.quality, args.model)
+        encoder = args.encoder if args.encoder is not None else defaultEncoder(args.processor, args.codec)
+        setMetricsFile(args.metrics)
+        progressInterval = args.progressInterval
+        staticThreshold = args.staticThreshold
+        retention = args.retention
+        targetBitrate = args.targetSize * 1048576 * 8 / 3600 if args.targetSize is not None else None
+        vmafFloor = args.vmafFloor
+        watchInterval = args.watchInterval
+        watchSettle = args.watchSettle
+        archiveDir = args.archiveDir
+        cards = [(card[0], card[1], args.model) for card in args.cards]
+        if args.batch is not None:
+            cards.extend(loadBatchConfig(args.batch))
+        if args.benchmark is not None:
+            benchmark(args.benchmark, args.model or "d5",
+                      args.benchEncoders.split(",") if args.benchEncoders else [encoder],
+                      args.benchPresets.split(",") if args.benchPresets else [args.preset],
+                      [int(q) for q in args.benchQualities.split(",")],
+                      args.benchJobs.split(","),
+                      args.stream, args.benchClips, args.benchDuration, args.benchResolution)
+        elif args.watch:
+            watch(args.input, args.output, args.length, encoder, args.quality, args.model or "d5", args.jobs, args.stream, args.probeCache, args.preset, args.staticMask, args.segmentLength, args.staticPolicy)
+        elif len(cards) > 0:
+            processBatch(cards, args.length, encoder, args.quality, args.jobs, args.stream, args.probeCache, args.preset, args.staticMask, args.segmentLength, args.staticPolicy)
+        else:
+            process(args.input, args.output, args.length, encoder, args.quality, args.model or "d5", args.jobs, args.stream, args.probeCache, args.preset, args.staticMask, args.segmentLength, args.staticPolicy)